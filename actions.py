@@ -1,18 +1,33 @@
 import asyncio
+import random
 import socket
+import time
 from dnslib import DNSRecord, RCODE, QTYPE
 from enum import Enum
 from dataclasses import dataclass, fields, asdict
 from utils.cache import DNSTCache
 from pathlib import Path
 from utils.fake_ip_pool import FakeIPPool
-from dnst_core import DNSTables, Trace
+from utils.nft_set import DNSTNftSets, families as nft_families
+from dnst_core import DNSTables, Trace, log_error
+from utils.stats import DNSTStats
+from utils.heavy_hitters import DNSTHeavyHitters
+from utils.upstream import DNSTUpstreams
+from utils import edns
+from utils.zone import Zone
+from utils.ipv4 import ip_to_int, int_to_ip, parse_ip, format_answer
 
 @dataclass
 class DNSTAction(Trace.with_name("action")):
     def __str__(self):
-        action_args = " ".join(f"{getattr(self, field.name)}" for field in fields(self))
-        return f"{self.action_str} {action_args}"
+        action_args = []
+        for field in fields(self):
+            value = getattr(self, field.name)
+            if field.default is not None: # positional argument
+                action_args.append(f"{value}")
+            elif value != None: # option, see DNSTActionBuilder.action_options
+                action_args.append(f"{field.name} {value}")
+        return f"{self.action_str} {' '.join(action_args)}"
 
     def msg_decor(self, msg):
         return f"action={self.action_str}\tmsg=\"{msg}\""
@@ -39,6 +54,35 @@ class DropAction(DNSTAction):
     pass
 
 
+# reply with the TC bit set and no answer, asking the client to retry over TCP
+@dataclass
+class TruncateAction(DNSTAction):
+    async def act(self, query, **kwargs):
+        self.debug(query, "truncate reply")
+        return "truncate"
+
+
+# response rate limiting style slip: truncate every Nth query and drop the others
+# "slip 0" always drops, "slip 1" always truncates
+@dataclass
+class SlipAction(DNSTAction):
+    slip: str
+    def __post_init__(self):
+        if not self.slip.isdigit():
+            raise ValueError(f"invalid slip {self.slip}, expecting a number")
+        self.slip_every = int(self.slip)
+
+    async def act(self, query, **kwargs):
+        if not hasattr(self, "counter"):
+            self.counter = 0
+        self.counter += 1
+        if self.slip_every > 0 and self.counter % self.slip_every == 0:
+            self.debug(query, "slip with truncated reply")
+            return "truncate"
+        self.debug(query, "slip with drop")
+        return "drop"
+
+
 @dataclass
 class JumpAction(DNSTAction):
     hook: str
@@ -55,48 +99,62 @@ class CallAction(DNSTAction):
         return await DNSTables.get_instance.feed(query, hook = self.hook)
 
 
+# sample: "K/N", only K out of N queries, picked at random, get the verbose level, the others are left as they are
 @dataclass
 class VerboseAction(DNSTAction):
     verbose: str
+    sample: str = None
+    def __post_init__(self):
+        self.verbose_str = next((k for k in Trace.verbose_lvl.keys() if self.verbose.startswith(k)), None)
+        if self.verbose_str == None:
+            raise ValueError(f"unknown verbose level {self.verbose}, available levels are {', '.join(Trace.verbose_lvl.keys())}")
+        self.verbose_int = Trace.verbose_lvl[self.verbose_str]
+        self.sample_rate = None
+        if self.sample != None:
+            k, _, n = self.sample.partition("/")
+            if not k.isdigit() or not n.isdigit() or int(n) == 0 or int(k) > int(n):
+                raise ValueError(f"invalid sample rate {self.sample}, expecting K/N, e.g., 1/1000")
+            self.sample_rate = int(k) / int(n)
+
     async def act(self, query, **kwargs):
-        if not hasattr(self, "verbose_int"):
-            self.verbose_int = None
-            for k, v in Trace.verbose_lvl.items():
-                if self.verbose.startswith(k):
-                    self.verbose_str = k
-                    self.verbose_int = v
-                    break
-            if self.verbose_int == None:
-                self.warn(f"unknown verbose level {self.verbose}. Available levels are \"{' ,'.joinTracer.verbose_lvl.keys()}\"")
-                return None
-            
-        if self.verbose_int != None:
-            query.set_verbose(self.verbose_int)
-            self.debug(query, f"verbose level set to {self.verbose_str}")
+        if self.sample_rate != None and random.random() >= self.sample_rate:
+            return None
+        query.set_verbose(self.verbose_int)
+        self.debug(query, f"verbose level set to {self.verbose_str}")
         return None
 
 
+# view: cache partition, so that clients getting different answers never share cached answers
+# size: max number of entries of the view
 @dataclass
 class CacheAction(DNSTAction):
+    view: str = None
+    size: str = None
+    def __post_init__(self):
+        if self.size != None and not self.size.isdigit():
+            raise ValueError(f"invalid cache size {self.size}")
+        self.max_entries = int(self.size) if self.size != None else None
+
     async def act(self, query, qname, qtype, answer, **kwargs):
         if query.has_answer():
             fake_net_pool = None
             if hasattr(query, "fake_net_pool"):
                 fake_net_pool = query.fake_net_pool
-            DNSTCache.get_instance().cache(qname, qtype, answer, fake_net_pool)
+            DNSTCache.get_instance().cache(qname, qtype, answer, fake_net_pool, view = self.view, max_entries = self.max_entries)
         return None
 
 
 @dataclass
 class CacheCheckAction(DNSTAction):
+    view: str = None
     async def act(self, query, qname, qtype, **kwargs):
         if query.has_answer():
             self.debug(query, "already got an anwer, do nothing")
             return None
-        cached_answer = DNSTCache.get_instance().get_cache(qname, qtype)
+        cached_answer = DNSTCache.get_instance().get_cache(qname, qtype, view = self.view)
         if cached_answer != None and len(cached_answer) > 0:
             query.answer = cached_answer
-            self.info(query, lambda: "cache check returns answer " + ", ".join([f"{ip}(ttl={ttl})" for ip, ttl in cached_answer]))
+            self.info(query, lambda: "cache check returns answer " + format_answer(cached_answer))
         return None
 
 
@@ -120,7 +178,10 @@ class ResolveFileAction(DNSTAction):
 
             ip, *hostnames = parts
             if qname in map(str.lower, hostnames):
-                query.answer = [(ip, 3600)]
+                try:
+                    query.answer = [(ip_to_int(ip), 3600)]
+                except OSError: # not an ipv4 address, e.g. "::1"
+                    continue
                 self.info(query, lambda: f"hosts file {self.hosts_file} returns answer {ip} ttl {3600}")
         return None
 
@@ -128,6 +189,9 @@ class ResolveFileAction(DNSTAction):
 @dataclass
 class ResolveAction(DNSTAction):
     mapped_answer: str # an ip address, or a dictionary describing qname->ip map
+    def __post_init__(self):
+        self.ip = None if self.mapped_answer.startswith("@") else parse_ip(self.mapped_answer)
+
     async def act(self, query, qname, **kwargs):
         if query.has_answer():
             self.debug(query, "already got an anwer, do nothing")
@@ -135,21 +199,62 @@ class ResolveAction(DNSTAction):
 
         if self.mapped_answer.startswith("@"):
             try:
-                ip_map = DNSTables.get_instance().maps[self.mapped_answer[1:]] # strip the leading '@'
-                if qname in ip_map.keys():
-                    query.answer = [(ip_map[qname], 3600)]
-                    self.info(query, lambda: f"local resolve {self.mapped_answer} returns answer {ip_map[qname]} ttl {3600}")
-                    return None
+                ip = DNSTables.get_instance().lookup_map(self.mapped_answer[1:], qname) # strip the leading '@'
             except KeyError: # map does not exist
-                self.warn(query, f"[{obj.__class__.__name__}]: cannot find map '{self.mapped_answer}'")
+                self.warn(query, f"cannot find map '{self.mapped_answer}'")
                 return None
+            if ip != None:
+                try:
+                    query.answer = [(ip_to_int(ip), 3600)]
+                except OSError:
+                    self.warn(query, f"map '{self.mapped_answer}' maps {qname} to {ip}, not an ipv4 address")
+                    return None
+                self.info(query, lambda: f"local resolve {self.mapped_answer} returns answer {ip} ttl {3600}")
+            return None
 
         # single ip
-        query.answer = [(self.mapped_answer, 3600)]
+        query.answer = [(self.ip, 3600)]
         self.info(query, lambda: f"local resolve returns answer {self.mapped_answer} ttl {3600}")
         return None
 
 
+zones = dict()
+# authoritative answers from a zone file, names inside the zone never go further down the chain
+@dataclass
+class ResolveZoneAction(DNSTAction):
+    zone_file: str
+    def __post_init__(self):
+        # loaded once and shared by every rule using the same file
+        if self.zone_file not in zones:
+            zones[self.zone_file] = Zone(self.zone_file)
+        self.zone = zones[self.zone_file]
+
+    async def act(self, query, qname, **kwargs):
+        if query.has_answer():
+            self.debug(query, "already got an anwer, do nothing")
+            return None
+
+        self.zone.check_reload()
+        qname = qname.lower()
+        if not self.zone.in_zone(qname):
+            return None
+        resolved = self.zone.resolve(qname)
+        if resolved == None:
+            self.debug(query, "cname points out of the zone, do nothing")
+            return None
+        answer, exists = resolved
+        query.authoritative = True
+        if len(answer) > 0:
+            query.answer = answer
+            self.info(query, lambda: f"zone {self.zone_file} returns answer " + format_answer(answer))
+        elif exists:
+            query.nodata = True
+            self.info(query, lambda: f"zone {self.zone_file} has no address for {qname}")
+        else:
+            self.info(query, lambda: f"zone {self.zone_file} has no name {qname}")
+        return "reply"
+
+
 @dataclass
 class ForwardAction(DNSTAction):
     upstream: str # upstream ip, or a dictionary describing qname->upstream map
@@ -162,11 +267,9 @@ class ForwardAction(DNSTAction):
         upstream_server = None
         if self.upstream.startswith("@"): # qname->upstream map
             try:
-                upstream_map = DNSTables.get_instance().maps[self.upstream[1:]]
-                if qname in upstream_map.keys():
-                    upstream_server = upstream_map["qname"]
+                upstream_server = DNSTables.get_instance().lookup_map(self.upstream[1:], qname)
             except KeyError: # map does not exist
-                self.warn(query, f"[{obj.__class__.__name__}]: cannot find map '{self.mapped_answer}'")
+                self.warn(query, f"cannot find map '{self.upstream}'")
                 return None
         else: # single upstream server
             upstream_server = self.upstream
@@ -181,24 +284,54 @@ class ForwardAction(DNSTAction):
                     upstream_ip = upstream_server
                     upstream_port = 53
 
+                upstream_stats = DNSTStats.get_instance().upstream(f"{upstream_ip}:{upstream_port}")
+                health = DNSTUpstreams.get_instance().get(upstream_ip, upstream_port)
+                if not health.available():
+                    upstream_stats.skipped += 1
+                    self.info(query, lambda: f"upstream {upstream_ip}:{upstream_port} is down, skipped")
+                    return None
+
+                upstream_stats.queries += 1
                 try:
                     # forward the query
                     self.debug(query, lambda: f"forwarding to upstream {upstream_ip}:{upstream_port}...")
-                    await loop.sock_sendto(sock, raw_query, (upstream_ip, upstream_port))
-                    future = loop.sock_recv(sock, 512)
-                    response_data = await asyncio.wait_for(future, timeout=5)
+                    start = time.perf_counter_ns()
+                    upstream_query = edns.upstream_query(raw_query)
+                    await loop.sock_sendto(sock, upstream_query, (upstream_ip, upstream_port))
+                    future = loop.sock_recv(sock, edns.MAX_UDP_SIZE)
+                    response_data = await asyncio.wait_for(future, timeout=health.timeout())
+                    response = DNSRecord.parse(response_data)
+                    if response.header.tc:
+                        # the answer did not fit in the advertised udp size, ask again over tcp
+                        self.debug(query, lambda: f"truncated reply from upstream {upstream_ip}:{upstream_port}, retrying over tcp")
+                        upstream_stats.tcp_retries += 1
+                        response_data = await edns.query_tcp(upstream_query, upstream_ip, upstream_port, health.timeout())
+                        response = DNSRecord.parse(response_data)
+                    rtt_ns = time.perf_counter_ns() - start
+                    upstream_stats.rtt.observe_ns(rtt_ns)
+                    DNSTHeavyHitters.get_instance().observe_upstream(qname, rtt_ns / 1e9)
+                    query.profile(f"upstream {upstream_ip}:{upstream_port}", start)
 
                     # parse upstream answer
-                    response = DNSRecord.parse(response_data)
+                    if response.header.rcode == RCODE.SERVFAIL:
+                        upstream_stats.servfail += 1
+                        health.failure()
+                    else:
+                        health.success(rtt_ns / 1e9)
                     if response.header.rcode != RCODE.NOERROR:
                         self.info(query, lambda: f"upstream {upstream_ip}:{upstream_port} returns error {RCODE.get(response.header.rcode, 'UNKNOWN')}")
                         return None
-                    query.answer = [(str(rr.rdata), rr.ttl) for rr in response.rr if rr.rtype == QTYPE.A]
-                    self.info(query, lambda: "received upstream reply " + ",".join([f"{ip}(ttl={ttl})" for ip, ttl in query.answer]))
+                    query.answer = [(int.from_bytes(bytes(rr.rdata.data), "big"), rr.ttl) for rr in response.rr if rr.rtype == QTYPE.A]
+                    self.info(query, lambda: "received upstream reply " + format_answer(query.answer))
 
                 except asyncio.TimeoutError:
+                    upstream_stats.timeouts += 1
+                    DNSTHeavyHitters.get_instance().observe_upstream(qname, (time.perf_counter_ns() - start) / 1e9)
+                    health.failure()
                     self.info(query, lambda: f"DNS query to upstream {upstream_ip}:{upstream_port} timed out")
                 except Exception as e:
+                    upstream_stats.errors += 1
+                    health.failure()
                     self.info(query, lambda: f"Forwarding DNS query to upstream {upstream_ip}:{upstream_port} failed: {e}")
 
         return None
@@ -226,13 +359,35 @@ class FakeIPAction(DNSTAction):
         real_ip, ttl = answer[0] # if multiple answers were provided, only pick the first one
         fake_ip = pool.register(qname, real_ip)
         if fake_ip == None:
-            self.err(query, f"Unable to map {qname}({real_ip}) to fake net {self.fake_net}")
+            self.err(query, lambda: f"Unable to map {qname}({int_to_ip(real_ip)}) to fake net {self.fake_net}")
             return None
 
         # overwrite answer ip
         query.answer = [(fake_ip, ttl)]
         setattr(query, "fake_net_pool", pool)
-        self.info(query, lambda: f"replace answer {real_ip} for {qname} with fake ip {fake_ip} from {self.fake_net}")
+        self.info(query, lambda: f"replace answer {int_to_ip(real_ip)} for {qname} with fake ip {int_to_ip(fake_ip)} from {self.fake_net}")
+        return None
+
+
+# add the answers to nftables set SET of table TABLE, each with a timeout of its ttl
+# the set is not created, it needs the timeout flag
+@dataclass
+class NftSetAction(DNSTAction):
+    family: str
+    table: str
+    nft_set: str
+    def __post_init__(self):
+        if self.family not in nft_families:
+            raise ValueError(f"unsupported family {self.family}, expecting one of {', '.join(nft_families)}")
+        self.target = (self.family, self.table, self.nft_set)
+
+    async def act(self, query, answer, **kwargs):
+        if not query.has_answer():
+            self.debug(query, "no answer received, skip")
+            return None
+        # only queued here, added off the loop
+        DNSTNftSets.get_instance().add(self.target, answer)
+        self.debug(query, lambda: f"adding {format_answer(answer)} to {' '.join(self.target)}")
         return None
 
 
@@ -243,6 +398,8 @@ class DNSTActionBuilder():
         "reply":    (ReplyAction, 0),
         "return":   (ReturnAction, 0),
         "drop":     (DropAction, 0),
+        "truncate": (TruncateAction, 0),
+        "slip":     (SlipAction, 1),
         "jump":     (JumpAction, 1),
         "call":     (CallAction, 1),
         "verbose":  (VerboseAction, 1),
@@ -250,8 +407,16 @@ class DNSTActionBuilder():
         "cachecheck":   (CacheCheckAction, 0),
         "resolvefile":  (ResolveFileAction, 1),
         "resolvelocal": (ResolveAction, 1),
+        "resolvezone":  (ResolveZoneAction, 1),
         "forward":  (ForwardAction, 1),
-        "fakeip":   (FakeIPAction, 1)
+        "fakeip":   (FakeIPAction, 1),
+        "nftset":   (NftSetAction, 3),
+    }
+    # optional "NAME VALUE" arguments following the positional ones
+    action_options = {
+        "cache":        ["view", "size"],
+        "cachecheck":   ["view"],
+        "verbose":      ["sample"],
     }
 
     # cmd is a list of words such as ["resolvefile", "/etc/hosts", ...]
@@ -268,10 +433,24 @@ class DNSTActionBuilder():
 
         if arg_cnt > len(cmd) - 1:
             return None
-        ret = ctor(*cmd[1:arg_cnt + 1])
+        consumed = arg_cnt + 1
+        options = dict()
+        allowed = cls.action_options.get(action_str, [])
+        while consumed < len(cmd) and cmd[consumed] in allowed:
+            if consumed + 1 >= len(cmd):
+                log_error(f"missing value for {action_str} option {cmd[consumed]}")
+                return None
+            options[cmd[consumed]] = cmd[consumed + 1]
+            consumed += 2
+
+        try:
+            ret = ctor(*cmd[1:arg_cnt + 1], **options)
+        except (OSError, ValueError) as e:
+            log_error(f"invalid action {action_str}: {e}")
+            return None
 
         if ret != None:
-            del cmd[:arg_cnt + 1]
+            del cmd[:consumed]
             setattr(ret, "action_str", action_str)
             return ret
         return None
@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+# compare two JSON results of bench/e2e.py (or bench/replay.py)
+# exits with 1 if a repeatable metric regressed by more than --threshold percent, or if a rule matched
+# a different number of the same queries. Timing metrics are only gated with --timing-threshold
+# e.g., python3 bench/compare.py baseline.json current.json --threshold 10
+
+import sys
+import json
+import argparse
+
+# metric path, True if higher is better
+# repeatable metrics are the same from run to run of the same code, replay.py pins the hash seed for them
+stable_metrics = [
+    (("alloc_bytes_per_query",), False),
+    (("retained_blocks_per_query",), False),
+]
+# timing metrics vary by tens of percent between runs of the same code on a busy machine
+timing_metrics = [
+    (("qps",), True),
+    (("latency_ms", "p50"), False),
+    (("latency_ms", "p99"), False),
+    (("latency_ms", "p999"), False),
+    (("cpu_us_per_query",), False),
+]
+
+def lookup(result, path):
+    for key in path:
+        if not isinstance(result, dict) or key not in result:
+            return None
+        result = result[key]
+    return result
+
+
+# prints the metrics found in both results, returns True if any regressed by more than threshold percent
+# threshold None only prints them
+def compare_metrics(baseline, current, metrics, threshold):
+    regressed = False
+    for path, higher_is_better in metrics:
+        old, new = lookup(baseline, path), lookup(current, path)
+        if old == None or new == None or old == 0:
+            continue
+        change = (new - old) / old * 100
+        worse = -change if higher_is_better else change
+        flag = ""
+        if threshold != None and worse > threshold:
+            flag = "  REGRESSION"
+            regressed = True
+        print(f"{'.'.join(path):26} {old:12.3f} -> {new:12.3f} ({change:+.1f}%){flag}")
+    return regressed
+
+
+# rules are matched by their text, the same queries should hit them the same number of times
+def compare_rules(baseline, current):
+    if baseline.get("queries") != current.get("queries"):
+        return False
+    old = {rule["rule"]: rule["packets"] for rule in baseline.get("rules", [])}
+    changed = False
+    for rule in current.get("rules", []):
+        packets = old.get(rule["rule"])
+        if packets != None and packets != rule["packets"]:
+            print(f"{rule['rule']}: {packets} -> {rule['packets']} packets  CHANGED")
+            changed = True
+    return changed
+
+
+# returns True on a regression
+def compare(baseline, current, threshold, timing_threshold = None):
+    regressed = compare_metrics(baseline, current, stable_metrics, threshold)
+    regressed = compare_rules(baseline, current) or regressed
+    print("timing" + ("" if timing_threshold != None else ", not gated:"))
+    return compare_metrics(baseline, current, timing_metrics, timing_threshold) or regressed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type = float, default = 10, help = "allowed regression of repeatable metrics in percent")
+    parser.add_argument("--timing-threshold", type = float, default = None,
+                        help = "allowed regression of timing metrics in percent, only reported if not given")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    sys.exit(1 if compare(baseline, current, args.threshold, args.timing_threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+# end-to-end load generation benchmark
+# starts server.py with a rulefile against an in-process stub upstream, then drives it with
+# zipf distributed A queries over UDP and reports QPS, latency percentiles and server CPU per query
+# e.g., python3 bench/e2e.py --rulefile bench/rulefiles/forward --duration 10 --output forward.json
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from itertools import accumulate
+from dnslib import DNSRecord, RR, QTYPE, A
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.join(bench_dir, "..")
+
+
+# latency distribution in milliseconds: "const:MS", "uniform:LO:HI", "exp:MEAN"
+def latency_sampler(spec, rng):
+    kind, *params = spec.split(":")
+    params = [float(p) / 1000 for p in params]
+    if kind == "const" and len(params) == 1:
+        return lambda: params[0]
+    elif kind == "uniform" and len(params) == 2:
+        return lambda: rng.uniform(params[0], params[1])
+    elif kind == "exp" and len(params) == 1:
+        return lambda: rng.expovariate(1 / params[0]) if params[0] > 0 else 0
+    raise ValueError(f"invalid latency distribution {spec}")
+
+
+class StubUpstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self, latency, answers):
+        self.latency = latency
+        self.answers = answers
+        self.queries = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.queries += 1
+        try:
+            request = DNSRecord.parse(data)
+        except Exception:
+            return
+        reply = request.reply()
+        for i in range(self.answers):
+            reply.add_answer(RR(request.q.qname, QTYPE.A, rdata = A(f"10.{i >> 8 & 255}.{i & 255}.1"), ttl = 300))
+        packed = reply.pack()
+        delay = self.latency()
+        if delay > 0:
+            asyncio.get_event_loop().call_later(delay, self.transport.sendto, packed, addr)
+        else:
+            self.transport.sendto(packed, addr)
+
+
+# stub upstream runs in its own thread with its own event loop
+class StubUpstream(threading.Thread):
+    def __init__(self, latency, answers):
+        super().__init__(daemon = True)
+        self.protocol = StubUpstreamProtocol(latency, answers)
+        self.ready = threading.Event()
+        self.port = None
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(
+            lambda: self.protocol, local_addr = ("127.0.0.1", 0)))
+        self.port = transport.get_extra_info("sockname")[1]
+        self.ready.set()
+        loop.run_forever()
+
+
+def zipf_qnames(names, exponent, count, rng):
+    cum_weights = list(accumulate(1 / (rank ** exponent) for rank in range(1, names + 1)))
+    ranks = rng.choices(range(names), cum_weights = cum_weights, k = count)
+    return [f"n{rank}.bench.test" for rank in ranks]
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def process_cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime and stime are fields 14 and 15, counting from the pid
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+class LoadGenProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.pending = dict() # query id, (future, send time)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        qid = int.from_bytes(data[:2], "big")
+        if qid in self.pending:
+            future, sent = self.pending.pop(qid)
+            if not future.done():
+                future.set_result(time.perf_counter() - sent)
+
+
+# dnsperf style closed loop: keep `concurrency` queries outstanding over one UDP socket
+async def run_load(port, qnames, duration, concurrency, timeout):
+    loop = asyncio.get_event_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        LoadGenProtocol, remote_addr = ("127.0.0.1", port))
+    latencies = []
+    timeouts = 0
+    next_qname = 0
+    next_id = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal timeouts, next_qname, next_id
+        while time.perf_counter() < deadline:
+            qname = qnames[next_qname % len(qnames)]
+            next_qname += 1
+            while next_id in protocol.pending:
+                next_id = (next_id + 1) & 0xffff
+            qid = next_id
+            next_id = (next_id + 1) & 0xffff
+            packet = DNSRecord.question(qname, "A")
+            packet.header.id = qid
+            future = loop.create_future()
+            protocol.pending[qid] = (future, time.perf_counter())
+            transport.sendto(packet.pack())
+            try:
+                latencies.append(await asyncio.wait_for(future, timeout))
+            except asyncio.TimeoutError:
+                protocol.pending.pop(qid, None)
+                timeouts += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    transport.close()
+    return latencies, timeouts, elapsed
+
+
+def percentile(sorted_values, q):
+    if len(sorted_values) == 0:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+async def wait_server(port, proc, timeout = 30):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() != None:
+            raise RuntimeError("server exited during startup")
+        latencies, _, _ = await run_load(port, ["warmup.bench.test"], 0.1, 1, 0.2)
+        if len(latencies) > 0:
+            return
+    raise RuntimeError("server did not answer in time")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rulefile", default = os.path.join(bench_dir, "rulefiles", "forward"),
+                        help = "rulefile for server.py, {upstream} is replaced with the stub upstream address")
+    parser.add_argument("--duration", type = float, default = 10, help = "seconds of measured load")
+    parser.add_argument("--warmup", type = float, default = 2, help = "seconds of unmeasured load")
+    parser.add_argument("--concurrency", type = int, default = 32, help = "outstanding queries")
+    parser.add_argument("--timeout", type = float, default = 2, help = "seconds before a query counts as lost")
+    parser.add_argument("--names", type = int, default = 100000, help = "number of distinct qnames")
+    parser.add_argument("--zipf", type = float, default = 1.1, help = "zipf exponent of qname popularity")
+    parser.add_argument("--upstream-latency", default = "exp:2", help = "const:MS, uniform:LO:HI or exp:MEAN")
+    parser.add_argument("--upstream-answers", type = int, default = 1, help = "A records per upstream reply")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", default = None, help = "write JSON result to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    upstream = StubUpstream(latency_sampler(args.upstream_latency, rng), args.upstream_answers)
+    upstream.start()
+    upstream.ready.wait()
+
+    with open(args.rulefile) as f:
+        rules = f.read().replace("{upstream}", f"127.0.0.1:{upstream.port}")
+    port = free_port()
+
+    with tempfile.NamedTemporaryFile("w", suffix = ".rules") as rulefile:
+        rulefile.write(rules)
+        rulefile.flush()
+        proc = subprocess.Popen([sys.executable, os.path.join(repo_dir, "server.py"),
+                                 "--listen", "127.0.0.1", "--port", str(port),
+                                 "--verbose", "none", "--rulefile", rulefile.name],
+                                stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        try:
+            asyncio.run(wait_server(port, proc))
+            qnames = zipf_qnames(args.names, args.zipf, 200000, rng)
+            if args.warmup > 0:
+                asyncio.run(run_load(port, qnames, args.warmup, args.concurrency, args.timeout))
+
+            cpu_start = process_cpu_seconds(proc.pid)
+            latencies, timeouts, elapsed = asyncio.run(
+                    run_load(port, qnames, args.duration, args.concurrency, args.timeout))
+            cpu = process_cpu_seconds(proc.pid) - cpu_start
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    latencies.sort()
+    answered = len(latencies)
+    result = {
+        "version": 1,
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "rulefile": os.path.basename(args.rulefile),
+        "python": platform.python_version(),
+        "answered": answered,
+        "timeouts": timeouts,
+        "qps": answered / elapsed,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.5) * 1000 if answered > 0 else None,
+            "p99": percentile(latencies, 0.99) * 1000 if answered > 0 else None,
+            "p999": percentile(latencies, 0.999) * 1000 if answered > 0 else None,
+        },
+        "cpu_us_per_query": cpu / answered * 1e6 if answered > 0 else None,
+        "upstream_queries": upstream.protocol.queries,
+    }
+    output = json.dumps(result, indent = 2)
+    print(output)
+    if args.output != None:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
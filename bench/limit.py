@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+# per query overhead of the "limit" matcher
+# e.g., python3 bench/limit.py --queries 1000000 --clients 100000
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dnst_core import DNSTQuery, Trace
+from matchers import DNSTMatcherBuilder, DNSTMatcher
+
+
+def bench(matcher, queries):
+    start = time.perf_counter()
+    for query in queries:
+        matcher.match(query, src_ip = query.src_ip)
+    return (time.perf_counter() - start) / len(queries) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type = int, default = 1000000)
+    parser.add_argument("--clients", type = int, default = 100000, help = "distinct client addresses")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    srcs = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(args.clients)]
+    queries = [
+        DNSTQuery(src = rng.choice(srcs), src_port = 53, qname = "www.example.com", qtype = "A",
+                  raw_query = b"", verbose = Trace.verbose_lvl["none"])
+        for _ in range(args.queries)
+    ]
+
+    baseline = bench(DNSTMatcher(), queries)
+    print(f"{'match everything':50} {baseline:8.0f} ns/query")
+    for rule in ["limit rate over 100/second",
+                 "limit rate over 100/second burst 200 per src",
+                 "limit rate over 1000/second burst 2000 per src/24"]:
+        matcher = DNSTMatcherBuilder.build(rule.split())
+        ns = bench(matcher, queries)
+        print(f"{rule:50} {ns:8.0f} ns/query (+{ns - baseline:.0f}) buckets={len(matcher.buckets)}")
+
+
+if __name__ == "__main__":
+    main()
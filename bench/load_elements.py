@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# load-time benchmark for "add element NAME file PATH"
+# e.g., python3 bench/load_elements.py --entries 1000000 10000000 --format hosts
+# also reports the time of qname lookups, and with --trace-memory the memory of the loaded elements
+
+import os
+import sys
+import time
+import resource
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from dnst_engine import cmd
+from dnst_core import DNSTables
+
+
+def gen_file(path, entries, fmt, is_map):
+    with open(path, "w") as f:
+        for i in range(entries):
+            domain = f"host{i}.example{i % 1000}.com"
+            if fmt == "hosts":
+                f.write(f"0.0.0.0 {domain}\n")
+            elif fmt == "csv":
+                f.write(f"{domain},10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}\n")
+            elif is_map:
+                f.write(f"{domain} 10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}\n")
+            else:
+                f.write(f"{domain}\n")
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def lookup_ns(target, keys):
+    start = time.perf_counter()
+    for key in keys:
+        key in target
+    return (time.perf_counter() - start) / len(keys) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, nargs="+", default=[1000000, 10000000])
+    parser.add_argument("--format", choices=["plain", "hosts", "csv"], default="plain")
+    parser.add_argument("--map", action="store_true", help="load into a map instead of a set")
+    parser.add_argument("--compact", action="store_true", help="load into a compact set")
+    parser.add_argument("--bloom", action="store_true", help="load into a compact set with a bloom filter")
+    parser.add_argument("--trace-memory", action="store_true", help="report the memory of the loaded elements, slows loading down")
+    args = parser.parse_args()
+
+    kind = "map" if args.map else "set"
+    options = ""
+    if not args.map and (args.compact or args.bloom):
+        options = " compact bloom" if args.bloom else " compact"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for entries in args.entries:
+            path = os.path.join(tmpdir, f"elements_{entries}")
+            gen_file(path, entries, args.format, args.map)
+            name = f"bench_{entries}"
+            cmd(f"add {kind} {name}{options}")
+
+            if args.trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            err = cmd(f"add element {name} file {path} format {args.format}")
+            elapsed = time.perf_counter() - start
+            size = f" size={tracemalloc.get_traced_memory()[0] / 2**20:.0f}MB" if args.trace_memory else ""
+            tracemalloc.stop()
+            if err != None:
+                print(err)
+                return
+
+            target = getattr(DNSTables.get_instance(), kind + "s")[name]
+            hits = [f"host{i}.example{i % 1000}.com" for i in range(0, entries, max(1, entries // 100000))]
+            misses = [f"miss{i}.example{i % 1000}.org" for i in range(len(hits))]
+            print(f"{kind}{options} {args.format} entries={entries} loaded={len(target)} "
+                  f"time={elapsed:.2f}s rate={entries / elapsed:.0f}/s{size} max_rss={max_rss_mb():.0f}MB "
+                  f"hit={lookup_ns(target, hits):.0f}ns miss={lookup_ns(target, misses):.0f}ns")
+            cmd(f"delete {kind} {name}")
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+# offline replay of queries through DNSTables.feed, without sockets
+# queries come from a query log (server.py --querylog), a pcap capture, or zipf distributed qnames,
+# forward is replaced by a stub with deterministic answers and configurable latency
+# reports evaluations per second, latency of feed, allocations per query and time per rule as JSON
+# e.g., python3 bench/replay.py --rulefile bench/rulefiles/cached --queries dns.pcap --baseline baseline.json
+
+import os
+import gc
+import sys
+import json
+import time
+import zlib
+import random
+import socket
+import struct
+import asyncio
+import argparse
+import platform
+import tracemalloc
+from array import array
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, ".."))
+from dnslib import DNSRecord, QTYPE
+from actions import ForwardAction
+from dnst_core import DNSTables, DNSTQuery, Trace
+from dnst_engine import cmd, iter_rulefile
+from utils import querylog
+from utils.admission import parse_question
+from e2e import latency_sampler, zipf_qnames, percentile
+from compare import compare
+
+# stands in for {upstream} in rulefiles, never contacted
+STUB_UPSTREAM = "192.0.2.53:53"
+
+pcap_magics = {
+    b"\xd4\xc3\xb2\xa1": "<", b"\xa1\xb2\xc3\xd4": ">", # microsecond timestamps
+    b"\x4d\x3c\xb2\xa1": "<", b"\xa1\xb2\x3c\x4d": ">", # nanosecond timestamps
+}
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+
+# ipv4 packet of a captured frame, or None
+def link_payload(linktype, frame):
+    if linktype == LINKTYPE_ETHERNET:
+        offset = 12
+        ethertype = int.from_bytes(frame[offset:offset + 2], "big")
+        while ethertype in (0x8100, 0x88a8): # vlan tags
+            offset += 4
+            ethertype = int.from_bytes(frame[offset:offset + 2], "big")
+        return frame[offset + 2:] if ethertype == 0x0800 else None
+    elif linktype == LINKTYPE_LINUX_SLL:
+        return frame[16:] if frame[14:16] == b"\x08\x00" else None
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        return frame[20:] if frame[0:2] == b"\x08\x00" else None
+    elif linktype == LINKTYPE_RAW:
+        return frame
+    elif linktype == LINKTYPE_NULL:
+        family = int.from_bytes(frame[:4], "little") or int.from_bytes(frame[:4], "big")
+        return frame[4:] if family == socket.AF_INET else None
+    return None
+
+
+# (src, src port, dns message) of an udp query to port 53, or None
+def udp_dns_query(packet):
+    if len(packet) < 20 or packet[0] >> 4 != 4 or packet[9] != 17:
+        return None
+    if int.from_bytes(packet[6:8], "big") & 0x3fff: # fragments
+        return None
+    ihl = (packet[0] & 0x0f) * 4
+    udp = packet[ihl:]
+    if len(udp) < 8:
+        return None
+    src_port, dst_port = struct.unpack_from("!HH", udp)
+    message = udp[8:]
+    if dst_port != 53 or len(message) < 12 or message[2] & 0x80: # replies have QR set
+        return None
+    return socket.inet_ntoa(packet[12:16]), src_port, message
+
+
+# yields (src, src port, qname, qtype) of the dns queries in a pcap file (not pcapng)
+def read_pcap(f):
+    header = f.read(24)
+    endian = pcap_magics.get(header[:4])
+    if len(header) < 24 or endian == None:
+        raise ValueError("not a pcap file")
+    linktype = struct.unpack_from(endian + "I", header, 20)[0] & 0xffff
+    record_header = struct.Struct(endian + "IIII")
+    while True:
+        data = f.read(record_header.size)
+        if len(data) < record_header.size:
+            return
+        caplen = record_header.unpack(data)[2]
+        packet = link_payload(linktype, f.read(caplen))
+        query = udp_dns_query(packet) if packet != None else None
+        if query == None:
+            continue
+        src, src_port, message = query
+        question = parse_question(message)
+        if question != None:
+            yield src, src_port, question[0], question[1]
+
+
+# yields (src, src port, qname, qtype) of a query log
+def read_querylog(f):
+    for record in querylog.read_stream(f):
+        src, src_port = record["src"].rsplit(":", 1)
+        yield src, int(src_port), record["qname"], record["qtype"]
+
+
+def load_queries(path):
+    with open(path, "rb") as f:
+        magic = f.read(len(querylog.MAGIC))
+        f.seek(0)
+        if magic == querylog.MAGIC:
+            return list(read_querylog(f))
+        return list(read_pcap(f))
+
+
+def synthetic_queries(names, exponent, count, clients, rng):
+    queries = []
+    for qname in zipf_qnames(names, exponent, count, rng):
+        client = rng.randrange(clients)
+        queries.append((f"10.0.{client >> 8 & 255}.{client & 255}", 53000, qname, QTYPE.A))
+    return queries
+
+
+# forward without an upstream: the same qname always gets the same answers
+def stub_forward(latency, answers):
+    async def act(self, query, qname, **kwargs):
+        if query.has_answer():
+            return None
+        delay = latency()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        base = zlib.crc32(qname.encode()) & 0xffffff
+        query.answer = [((10 << 24) | ((base + i) & 0xffffff), 300) for i in range(answers)]
+        return None
+    return act
+
+
+async def feed(queries, verbose):
+    dnstables = DNSTables.get_instance()
+    latencies = array("q") # not one int object per query, which would count as retained blocks
+    for src, src_port, qname, raw_query in queries:
+        start = time.perf_counter_ns()
+        query = DNSTQuery(src = src, src_port = src_port, qname = qname, qtype = "A",
+                          raw_query = raw_query, verbose = verbose)
+        await dnstables.feed(query)
+        latencies.append(time.perf_counter_ns() - start)
+    return latencies
+
+
+# peak memory allocated while feeding each query, on top of what was allocated before
+async def alloc_bytes(queries, verbose):
+    dnstables = DNSTables.get_instance()
+    peaks = []
+    tracemalloc.start()
+    try:
+        for src, src_port, qname, raw_query in queries:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            query = DNSTQuery(src = src, src_port = src_port, qname = qname, qtype = "A",
+                              raw_query = raw_query, verbose = verbose)
+            await dnstables.feed(query)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def rule_stats(measured):
+    dnstables = DNSTables.get_instance()
+    rules = []
+    for hook in dnstables.hooks:
+        for rule in dnstables.chains[hook]:
+            rules.append({
+                "rule": f"{hook}[{rule.index}] {rule}",
+                "packets": rule.packets,
+                "ns_per_query": rule.time_ns / measured if measured > 0 else None,
+            })
+    return rules
+
+
+def reset_rule_counters():
+    dnstables = DNSTables.get_instance()
+    for rulechain in dnstables.chains.values():
+        for rule in rulechain:
+            rule.reset_counters()
+
+
+async def replay(args, queries, verbose):
+    if args.warmup > 0:
+        await feed(queries[:args.warmup], verbose)
+    reset_rule_counters()
+    # rules, sets and warmed up caches are long lived, keep the collector from walking them while measuring
+    gc.collect()
+    gc.freeze()
+    blocks = sys.getallocatedblocks()
+    # the fastest pass is the one least disturbed by the rest of the machine
+    cpu, latencies = None, None
+    for _ in range(args.passes):
+        cpu_start = time.process_time()
+        pass_latencies = await feed(queries, verbose)
+        pass_cpu = time.process_time() - cpu_start
+        if cpu == None or pass_cpu < cpu:
+            cpu, latencies = pass_cpu, pass_latencies
+    gc.collect() # only what the queries left reachable counts, not garbage the collector has yet to free
+    retained = (sys.getallocatedblocks() - blocks) / (len(queries) * args.passes)
+    rules = rule_stats(len(queries) * args.passes)
+    peaks = await alloc_bytes(queries[:args.alloc_queries], verbose) if args.alloc_queries > 0 else []
+    return latencies, cpu, retained, rules, peaks
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rulefile", default = os.path.join(bench_dir, "rulefiles", "cached"),
+                        help = "rulefile to replay through, {upstream} is replaced with the stub upstream")
+    parser.add_argument("--queries", default = None,
+                        help = "query log or pcap file to replay, zipf distributed qnames if not given")
+    parser.add_argument("--count", type = int, default = 100000, help = "synthetic queries, or at most this many loaded queries")
+    parser.add_argument("--names", type = int, default = 10000, help = "distinct synthetic qnames")
+    parser.add_argument("--zipf", type = float, default = 1.1, help = "zipf exponent of synthetic qname popularity")
+    parser.add_argument("--clients", type = int, default = 256, help = "distinct synthetic client addresses")
+    parser.add_argument("--passes", type = int, default = 3, help = "measured replays of the queries, the fastest one is reported")
+    parser.add_argument("--warmup", type = int, default = 10000, help = "unmeasured queries replayed first")
+    parser.add_argument("--alloc-queries", type = int, default = 2000, help = "queries replayed again under tracemalloc")
+    parser.add_argument("--upstream-latency", default = "const:0", help = "stub forward latency, const:MS, uniform:LO:HI or exp:MEAN")
+    parser.add_argument("--upstream-answers", type = int, default = 1, help = "A records per stub forward answer")
+    parser.add_argument("--verbose", default = "none", choices = list(Trace.verbose_lvl.keys()))
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", default = None, help = "write JSON result to this file")
+    parser.add_argument("--baseline", default = None, help = "JSON result to compare with, exits with 1 on regression")
+    parser.add_argument("--threshold", type = float, default = 10, help = "allowed regression of repeatable metrics in percent")
+    parser.add_argument("--timing-threshold", type = float, default = None,
+                        help = "allowed regression of timing metrics in percent, only reported if not given")
+    args = parser.parse_args()
+
+    # set and dict layouts depend on the hash seed, the memory metrics only repeat from run to run with a fixed one
+    if os.environ.get("PYTHONHASHSEED") != "0":
+        os.environ["PYTHONHASHSEED"] = "0"
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    rng = random.Random(args.seed)
+    ForwardAction.act = stub_forward(latency_sampler(args.upstream_latency, rng), args.upstream_answers)
+    for line in iter_rulefile(args.rulefile):
+        err = cmd(line.replace("{upstream}", STUB_UPSTREAM))
+        if err != None:
+            sys.exit(f"error while parsing rulefile {args.rulefile}: {err}")
+
+    if args.queries != None:
+        loaded = load_queries(args.queries)[:args.count]
+    else:
+        loaded = synthetic_queries(args.names, args.zipf, args.count, args.clients, rng)
+    # like server.py, only A queries go through the rules
+    raw_queries = dict()
+    queries = []
+    for src, src_port, qname, qtype in loaded:
+        if qtype != QTYPE.A:
+            continue
+        if qname not in raw_queries:
+            raw_queries[qname] = bytes(DNSRecord.question(qname, "A").pack())
+        queries.append((src, src_port, qname, raw_queries[qname]))
+    if len(queries) == 0:
+        sys.exit("no A queries to replay")
+
+    latencies, cpu, retained, rules, peaks = asyncio.run(replay(args, queries, Trace.verbose_lvl[args.verbose]))
+    latencies = sorted(latencies)
+    measured = len(latencies)
+    result = {
+        "version": 1,
+        "config": {k: v for k, v in vars(args).items() if k not in ["output", "baseline"]},
+        "rulefile": os.path.basename(args.rulefile),
+        "python": platform.python_version(),
+        "queries": measured,
+        "skipped": len(loaded) - len(queries),
+        "qps": measured / cpu if cpu > 0 else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.5) / 1e6,
+            "p99": percentile(latencies, 0.99) / 1e6,
+            "p999": percentile(latencies, 0.999) / 1e6,
+        },
+        "cpu_us_per_query": cpu / measured * 1e6,
+        "alloc_bytes_per_query": sum(peaks) / len(peaks) if len(peaks) > 0 else None,
+        "retained_blocks_per_query": retained,
+        "rules": rules,
+    }
+    output = json.dumps(result, indent = 2)
+    print(output)
+    if args.output != None:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+    if args.baseline != None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        sys.exit(1 if compare(baseline, result, args.threshold, args.timing_threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,75 @@
 #!/usr/bin/python3
 
+import json
 import socket
+import time
 import sys
 import os
 
-CMD_SOCKET_PATH = "/tmp/nftabels.sock"
+CMD_SOCKET_PATH = os.environ.get("DNST_SOCKET", "/tmp/nftabels.sock")
 BUFFER_SIZE = 1024
 
+def send(message):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
+        client_socket.connect(CMD_SOCKET_PATH)
+        client_socket.sendall(message.encode())
+        client_socket.shutdown(socket.SHUT_WR) # end of command
+
+        response = b""
+        while True:
+            chunk = client_socket.recv(BUFFER_SIZE)
+            if not chunk:
+                break  # No more data, the daemon closed the connection
+            response += chunk  # Append the chunk to the response
+        return response.decode()
+
+
+def format_top(result):
+    sections = []
+    for kind, top in result["tops"].items():
+        lines = [f"{kind}: {top['total']:.1f} {top['unit']} (half-life {result['half_life']}s)",
+                 f"{'weight':>12} {'error':>10}  key"]
+        digits = 4 if "seconds" in top["unit"] else 1
+        for entry in top["top"]:
+            lines.append(f"{entry['weight']:>12.{digits}f} {entry['error']:>10.{digits}f}  {entry['key']}")
+        sections.append("\n".join(lines))
+    return "\n\n".join(sections)
+
+
+# like top(1): "top [-d SECONDS] [-n ITERATIONS] [json] ..." redraws every SECONDS, until interrupted or ITERATIONS redraws
+def live_top(args):
+    delay = 2.0
+    iterations = 0
+    while len(args) >= 2 and args[0] in ["-d", "-n"]:
+        if args[0] == "-d":
+            delay = float(args[1])
+        else:
+            iterations = int(args[1])
+        args = args[2:]
+    raw = "json" in args
+    message = " ".join(["top"] + [arg for arg in args if arg != "json"])
+    drawn = 0
+    try:
+        while True:
+            response = send(message)
+            try:
+                result = json.loads(response)
+            except ValueError: # "ok" after a reset, or an error
+                print(response)
+                return
+            output = response if raw else format_top(result)
+            print("\033[H\033[2J" + output if sys.stdout.isatty() and not raw else output, flush = True)
+            drawn += 1
+            if raw or drawn == iterations:
+                return
+            time.sleep(delay)
+    except KeyboardInterrupt:
+        pass
+
+
 def main():
     if not os.path.exists(CMD_SOCKET_PATH):
-        print(f"Error: {SOCKET_PATH} does not exist. Is the daemon running?")
+        print(f"Error: {CMD_SOCKET_PATH} does not exist. Is the daemon running?")
         return
 
     # TODO: show --help instead
@@ -17,26 +77,18 @@ def main():
         print("Error: Please provide arguments.")
         return
 
-    # Ignore the script name (sys.argv[0])
-    message = " ".join(sys.argv[1:])
+    try:
+        if sys.argv[1] == "top":
+            live_top(sys.argv[2:])
+            return
 
-    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
-        try:
-            client_socket.connect(CMD_SOCKET_PATH)
-            client_socket.sendall(message.encode())
-
-            response = b""
-            while True:
-                chunk = client_socket.recv(BUFFER_SIZE)
-                if not chunk:
-                    break  # No more data, the daemon closed the connection
-                response += chunk  # Append the chunk to the response
-            print(response.decode())
-
-        except ConnectionRefusedError:
-            print(f"Could not connect to {CMD_SOCKET_PATH}. Is the daemon running?")
-        except Exception as e:
-            print(f"Error: {e}")
+        # Ignore the script name (sys.argv[0])
+        print(send(" ".join(sys.argv[1:])))
+
+    except ConnectionRefusedError:
+        print(f"Could not connect to {CMD_SOCKET_PATH}. Is the daemon running?")
+    except Exception as e:
+        print(f"Error: {e}")
 
 if __name__ == "__main__":
     main()
@@ -1,38 +1,20 @@
 import asyncio
 import copy
-import datetime
 import sys
+import time
 from dataclasses import dataclass, asdict, field
+from collections import OrderedDict
+from utils.stats import DNSTStats
+from utils.logger import DNSTLogger
+from utils.ipv4 import ip_to_int
 
-class DNSTLogger:
-    _instance = None
-
-    @classmethod
-    def get_instance(cls):
-        if cls._instance == None:
-            cls._instance = cls()
-        return cls._instance
-
-    def __init__(self):
-        self._queue = asyncio.Queue()
-        asyncio.ensure_future(self._logger())
-
-    async def _logger(self):
-        while True:
-            msg = await self._queue.get()
-            if msg is None:
-                break
-            print(msg)
-            sys.stdout.flush()
-            self._queue.task_done()
+async def log(msg):
+    await DNSTLogger.get_instance().aprint(msg)
 
-    async def aprint(self, msg):
-        await self._queue.put(msg)
 
-
-async def log(msg):
-    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    await DNSTLogger.get_instance().aprint(f"[{timestamp}] {msg}")
+# errors outside of query traces, e.g. while parsing commands, go to the log file as well
+def log_error(msg):
+    DNSTLogger.get_instance().log(f"[ERROR] {msg}")
 
 
 @dataclass
@@ -44,18 +26,29 @@ class DNSTQuery:
     raw_query: bytes
     verbose: int
     trace_logs: list = field(default_factory=list)
-    answer: list = field(default_factory=list)
+    answer: list = field(default_factory=list) # [(ip as int, ttl)]
+    timeline: list = None # (event, start_ns, duration_ns) when profiling is on
+    answered_by: str = None # "hook[index]" of the last rule that set the answer
+    authoritative: bool = False # answered from a local zone
+    nodata: bool = False # the name exists without an address, replied to with NOERROR and no answer
+    src_ip: int = None # src as int, for ip matching
+
+    def __post_init__(self):
+        if self.src_ip == None:
+            self.src_ip = ip_to_int(self.src)
 
     def set_verbose(self, lvl):
         self.verbose = lvl
 
+    def profile(self, event, start_ns):
+        if self.timeline != None:
+            self.timeline.append((event, start_ns, time.perf_counter_ns() - start_ns))
+
     async def trace_flush(self):
         if len(self.trace_logs) == 0:
             return
 
-        if len(self.trace_logs) > 0:
-            msg = "\n".join(self.trace_logs)
-            await DNSTLogger.get_instance().aprint(msg)
+        DNSTLogger.get_instance().write_many(self.trace_logs)
         self.trace_logs = []
 
     def has_answer(self):
@@ -85,8 +78,8 @@ class Trace():
                 # ]))
                 msg = msg()
 
-            timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            query.trace_logs.append(f"[{timestamp}] level={lvl}\ttracer={self.tracer_name}\t{self.msg_decor(msg)}")
+            # formatted by the logger's writer thread
+            query.trace_logs.append((time.time(), lvl, self.tracer_name, self.msg_decor(msg)))
 
     # tracers can overwrite this to decorate their own msg
     def msg_decor(self, msg):
@@ -113,6 +106,10 @@ class DNSTRule(Trace.with_name("rule")):
         self.actions = []
         self.hook = None
         self.index = None
+        # nftables style counters
+        self.packets = 0
+        self.bytes = 0
+        self.time_ns = 0 # time spent in matcher and actions
 
     def __str__(self):
         actions_str = " ".join([str(action) for action in self.actions])
@@ -130,27 +127,148 @@ class DNSTRule(Trace.with_name("rule")):
     def add_action(self, action):
         self.actions.append(action)
 
-    async def apply(self, query):
+    def reset_counters(self):
+        self.packets = 0
+        self.bytes = 0
+        self.time_ns = 0
+
+    # matched: True if the matcher is already known to match (memoized), None to evaluate it
+    async def apply(self, query, matched = None):
         ret = None
-        matched = True
-        if self.matcher != None:
-            matched = self.matcher.match(query = query, **asdict(query))
+        start = time.perf_counter_ns()
+        if matched == None:
+            matched = True
+            if self.matcher != None:
+                matched = self.matcher.match(query = query, **asdict(query))
+                query.profile(f"rule {self.hook}[{self.index}] match", start)
         if matched:
+            self.packets += 1
+            self.bytes += len(query.raw_query)
             self.debug(query, f"query matched: qname={query.qname}, src={query.src}:{query.src_port}")
+            stats = DNSTStats.get_instance()
             for action in self.actions:
                 if action.action_str in ["return", "reply", "drop"]:
                     ret = action.action_str
                     break
+                action_start = time.perf_counter_ns()
+                answer = query.answer
                 ret = await action.act(query = query, **asdict(query))
+                if query.answer is not answer:
+                    query.answered_by = f"{self.hook}[{self.index}]"
+                stats.observe_action(action.action_str, time.perf_counter_ns() - action_start)
+                query.profile(f"rule {self.hook}[{self.index}] action {action.action_str}", action_start)
                 if ret != None:
                     break
         else:
             self.debug(query, f"skipped rule")
+        self.time_ns += time.perf_counter_ns() - start
 
         await query.trace_flush()
         return ret
 
 
+# per-chain dispatch index, built from the leading qname/src matcher of each rule (see DNSTMatcher.index_keys)
+# a query only evaluates the rules that can possibly match it, in their original order
+# candidates are (rule, matched) pairs, matched is None since matchers still need evaluating
+class ChainIndex:
+    min_indexed_rules = 4 # a linear scan is cheaper for smaller chains
+    static_depends = frozenset(["qname", "src"])
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.always = [] # positions of rules that can't be indexed
+        self.exact = dict() # qname, positions
+        self.suffix = dict() # "google.com" for "*.google.com", positions
+        self.src = dict() # prefixlen, {network (int), positions}
+        self.indexed = 0
+
+        for pos, rule in enumerate(rules):
+            keys = rule.matcher.index_keys() if rule.matcher != None else None
+            if keys == None:
+                self.always.append(pos)
+                continue
+            self.indexed += 1
+            for kind, value in keys:
+                if kind == "exact":
+                    self.exact.setdefault(value, []).append(pos)
+                elif kind == "suffix":
+                    self.suffix.setdefault(value, []).append(pos)
+                else: # src
+                    prefixlen, network = value
+                    self.src.setdefault(prefixlen, dict()).setdefault(network, []).append(pos)
+        self.all_rules = [(rule, None) for rule in rules]
+        self.always_rules = [(rules[pos], None) for pos in self.always]
+        self.use_index = self.indexed >= self.min_indexed_rules
+
+        # split each rule's matcher into its and-ed conjuncts
+        # static ones only depend on qname/src, so their result can be memoized (see DNSTables.chain_rules)
+        # rules with stateful matchers (e.g. limit) are always fully evaluated
+        self.static = [] # by position, (static conjuncts, has dynamic conjuncts), or None
+        self.uses_src = False
+        for rule in rules:
+            if rule.matcher == None:
+                self.static.append(([], False))
+                continue
+            depends = rule.matcher.depends()
+            if "state" in depends:
+                self.static.append(None)
+                continue
+            conjuncts = rule.matcher.conjuncts()
+            static = [m for m in conjuncts if m.depends() <= self.static_depends]
+            self.static.append((static, len(static) < len(conjuncts)))
+            self.uses_src = self.uses_src or any("src" in m.depends() for m in static)
+        self.memoizable = any(static != None and len(static[0]) > 0 for static in self.static)
+
+    def candidates(self, qname, src_ip):
+        if not self.use_index:
+            return self.all_rules
+        positions = self.positions(qname, src_ip)
+        if positions is self.always:
+            return self.always_rules
+        return [(self.rules[pos], None) for pos in positions]
+
+    # positions of the rules that can match, in order
+    def positions(self, qname, src_ip):
+        if not self.use_index:
+            return range(len(self.rules))
+        hits = []
+        if qname in self.exact:
+            hits.extend(self.exact[qname])
+        if len(self.suffix) > 0:
+            # "www.google.com" looks up "google.com" and "com"
+            dot = qname.find('.')
+            while dot >= 0:
+                suffix_hits = self.suffix.get(qname[dot + 1:])
+                if suffix_hits != None:
+                    hits.extend(suffix_hits)
+                dot = qname.find('.', dot + 1)
+        if len(self.src) > 0:
+            for prefixlen, networks in self.src.items():
+                src_hits = networks.get(src_ip >> (32 - prefixlen))
+                if src_hits != None:
+                    hits.extend(src_hits)
+
+        if len(hits) == 0:
+            return self.always
+        hits.extend(self.always)
+        return sorted(set(hits))
+
+    # evaluate static conjuncts of the candidates once
+    # drops rules that can't match, marks rules without dynamic conjuncts as matched
+    def memoize(self, query):
+        kwargs = asdict(query)
+        path = []
+        for pos in self.positions(query.qname, query.src_ip):
+            rule = self.rules[pos]
+            if self.static[pos] == None:
+                path.append((rule, None))
+                continue
+            static, has_dynamic = self.static[pos]
+            if all(m.match(query = query, **kwargs) for m in static):
+                path.append((rule, None if has_dynamic else True))
+        return path
+
+
 class DNSTables(Trace.with_name("tables")):
     _instance = None
 
@@ -165,6 +283,12 @@ class DNSTables(Trace.with_name("tables")):
         self.maps = dict() # name, map
         self.hooks = [] # hooks are ordered
         self.chains = dict() # hook, rules
+        self.chain_indexes = dict() # hook, ChainIndex, built on first use
+        self.memo = OrderedDict() # (hook, qname, qtype, src), memoized rule path, LRU
+        self.memo_size = 65536
+        self.set_generation = 0 # bumped on any set change, for matchers caching set derived data
+        self.element_watchers = dict() # name, background file watcher task
+        self.watch_specs = dict() # name, (path, format, period) of the watched element file
 
     def __str__(self):
         lines = []
@@ -187,6 +311,50 @@ class DNSTables(Trace.with_name("tables")):
             lines.append("}\n")
         return "\n".join(lines)
 
+    # look up qname in map `name`, raises KeyError if the map does not exist
+    # exact keys win, then the longest wildcard key: "*.b.example.com", "*.example.com", "*.com"
+    def lookup_map(self, name, qname):
+        target = self.maps[name]
+        value = target.get(qname)
+        if value != None:
+            return value
+        dot = qname.find('.')
+        while dot >= 0:
+            value = target.get('*' + qname[dot:])
+            if value != None:
+                return value
+            dot = qname.find('.', dot + 1)
+        return None
+
+    # must be called whenever rules of a chain are added/deleted
+    def chain_changed(self, hook):
+        self.chain_indexes.pop(hook, None)
+        self.memo.clear()
+
+    # must be called whenever a set or its elements changes
+    def sets_changed(self):
+        self.set_generation += 1
+        self.memo.clear()
+
+    # (rule, matched) pairs to evaluate for query in chain hook, in order
+    def chain_rules(self, hook, query):
+        if hook not in self.chain_indexes:
+            self.chain_indexes[hook] = ChainIndex(self.chains[hook])
+        index = self.chain_indexes[hook]
+        if not index.memoizable:
+            return index.candidates(query.qname, query.src_ip)
+
+        key = (hook, query.qname, query.qtype, query.src_ip if index.uses_src else None)
+        path = self.memo.get(key)
+        if path != None:
+            self.memo.move_to_end(key)
+            return path
+        path = index.memoize(query)
+        self.memo[key] = path
+        if len(self.memo) > self.memo_size:
+            self.memo.popitem(last = False)
+        return path
+
     async def feed(self, query, hook = None, _hook_index = None):
         if _hook_index != None:
             hook = self.hooks[_hook_index]
@@ -196,23 +364,29 @@ class DNSTables(Trace.with_name("tables")):
         elif hook not in self.hooks:
             self.err(query, f"unknown chain name {hook}")
             return "drop"
+        else:
+            _hook_index = self.hooks.index(hook)
 
         if hook != None:
             self.debug(query, f"enter chain {hook}")
-            for rule in self.chains[hook]:
-                err = await rule.apply(query)
-                if err == None:
-                    continue
-                elif err == "return":
-                    # exit the current rule chain
+            err = None
+            start = time.perf_counter_ns()
+            for rule, matched in self.chain_rules(hook, query):
+                err = await rule.apply(query, matched)
+                if err != None:
                     break
-                elif err == "reply":
-                    # return (recursively) from feed()
-                    return None
-                elif err.startswith("jump2hook "):
-                    return await self.feed(query, hook = err[10:])
-                else:
-                    return err
+            DNSTStats.get_instance().observe_chain(hook, time.perf_counter_ns() - start)
+
+            if err == None or err == "return":
+                # exit the current rule chain
+                pass
+            elif err == "reply":
+                # return (recursively) from feed()
+                return None
+            elif err.startswith("jump2hook "):
+                return await self.feed(query, hook = err[10:])
+            else:
+                return err
 
             # feed into the next chainrule
             if _hook_index < len(self.hooks) - 1:
@@ -1,39 +1,237 @@
-from dnst_core import DNSTRule, DNSTables
+import asyncio
+import json
+import pickle
+import threading
+from dnst_core import DNSTRule, DNSTables, log, log_error
 from matchers import DNSTMatcherBuilder, OrMatcher
-from actions import DNSTActionBuilder
+from actions import DNSTActionBuilder, ResolveZoneAction, fake_ip_pools, zones
+from utils.cache import DNSTCache
+from utils.stats import DNSTStats, PrometheusWriter
+from utils.profiler import DNSTProfiler
+from utils.heavy_hitters import DNSTHeavyHitters
+from utils.watchdog import DNSTWatchdog
+from utils.nft_set import DNSTNftSets
+from utils.logger import DNSTLogger
+from utils.querylog import DNSTQueryLog
+from utils.upstream import DNSTUpstreams
+from utils.admission import DNSTAdmission
+from utils.element_file import formats, load_elements, file_signature
+from utils.compact_set import CompactSet
+from utils.snapshot import write_snapshot, read_snapshot
 
+_staging = threading.local()
+
+# the tables commands apply to: the live ones, or the ones a reload is building in a worker thread
+def tables():
+    staged = getattr(_staging, "tables", None)
+    return staged if staged != None else DNSTables.get_instance()
+
+
+# an empty set of the same kind as target
+def new_set_like(target):
+    if isinstance(target, CompactSet):
+        return CompactSet(bloom = target.use_bloom)
+    return set()
+
+
+# cmd: ["set", NAME, ["compact", ["bloom"]]] or ["map", NAME]
 def add_del_set_map(is_add, cmd):
     #TODO: specify element types during set/map declaration
-    if len(cmd) != 2 or cmd[0] not in ["set", "map"]:
-        print("invalid add/delete set/map syntax")
+    if len(cmd) < 2 or cmd[0] not in ["set", "map"]:
+        log_error("invalid add/delete set/map syntax")
+        return -1
+    options = cmd[2:]
+    if len(options) > 0 and (not is_add or cmd[0] != "set" or options not in [["compact"], ["compact", "bloom"]]):
+        log_error("invalid set options, expecting 'add set NAME [compact [bloom]]'")
         return -1
     is_map = cmd[0] == "map"
     name = cmd[1]
-    dnstables = DNSTables.get_instance()
+    dnstables = tables()
 
     if is_add:
         if is_map and name not in dnstables.maps:
             dnstables.maps[name] = dict()
         elif not is_map and name not in dnstables.sets:
-            dnstables.sets[name] = set()
+            if "compact" in options:
+                dnstables.sets[name] = CompactSet(bloom = "bloom" in options)
+            else:
+                dnstables.sets[name] = set()
+            dnstables.sets_changed()
     else:
         if is_map and name not in dnstables.maps or not is_map and name not in dnstables.sets:
-            print(f"unable to find {name} with type {cmd[0]}")
+            log_error(f"unable to find {name} with type {cmd[0]}")
             return -1
         if is_map:
             del dnstables.maps[name]
         else:
             del dnstables.sets[name]
+            dnstables.sets_changed()
+        stop_watch_element_file(name)
     return 0
 
+
+def stop_watch_element_file(name):
+    dnstables = tables()
+    dnstables.watch_specs.pop(name, None)
+    watcher = dnstables.element_watchers.pop(name, None)
+    if watcher != None:
+        watcher.cancel()
+
+
+# watchers of staged tables are only started once the reload is applied, from the loop
+def start_watch_element_file(name, path, fmt, period):
+    stop_watch_element_file(name)
+    dnstables = tables()
+    dnstables.watch_specs[name] = (path, fmt, period)
+    if dnstables is DNSTables.get_instance():
+        dnstables.element_watchers[name] = asyncio.ensure_future(watch_element_file(name, path, fmt, period))
+
+
+# re-ingest the file into a fresh set/map whenever it changes, then swap it in
+async def watch_element_file(name, path, fmt, period):
+    loop = asyncio.get_event_loop()
+    dnstables = DNSTables.get_instance()
+    signature = file_signature(path)
+    while True:
+        await asyncio.sleep(period)
+        new_signature = file_signature(path)
+        if new_signature == None or new_signature == signature:
+            continue
+        signature = new_signature
+
+        is_map = name in dnstables.maps
+        if is_map:
+            target = dict()
+        elif name in dnstables.sets:
+            target = new_set_like(dnstables.sets[name])
+        else:
+            break # set was deleted meanwhile
+        try:
+            # parse in a worker thread, the live set/map is only touched from the loop
+            count = await loop.run_in_executor(None, load_elements, target, path, fmt)
+        except Exception as e:
+            await log(f"failed to reload elements of {name} from {path}: {e}")
+            continue
+
+        if is_map and name in dnstables.maps:
+            dnstables.maps[name] = target
+        elif not is_map and name in dnstables.sets:
+            dnstables.sets[name] = target
+            dnstables.sets_changed()
+        else:
+            break # set/map was deleted meanwhile
+        await log(f"reloaded {count} elements of {name} from {path}")
+
+
+# cmd: [PATH, ["format", FORMAT], ["watch", [PERIOD]]], returns (path, format, watch period) or None
+def parse_element_file(is_add, cmd):
+    if len(cmd) < 1:
+        log_error("invalid add/delete element file syntax")
+        return None
+    path = cmd.pop(0)
+    fmt = "plain"
+    watch_period = None
+    while len(cmd) > 0:
+        opt = cmd.pop(0)
+        if opt == "format" and len(cmd) > 0 and cmd[0] in formats:
+            fmt = cmd.pop(0)
+        elif opt == "watch" and is_add:
+            watch_period = 5
+            if len(cmd) > 0 and cmd[0].isdigit():
+                watch_period = int(cmd.pop(0))
+        else:
+            log_error(f"invalid element file option {opt}, available formats are \"{', '.join(formats)}\"")
+            return None
+    return path, fmt, watch_period
+
+
+# in place, for the rulefile at startup and reload staging, see element_file_cmd for the control socket
+# cmd: [PATH, ["format", FORMAT], ["watch", [PERIOD]]]
+def add_del_element_file(is_add, name, target, cmd):
+    parsed = parse_element_file(is_add, cmd)
+    if parsed == None:
+        return -1
+    path, fmt, watch_period = parsed
+    try:
+        load_elements(target, path, fmt, is_add)
+    except OSError as e:
+        log_error(f"unable to load elements from {path}: {e}")
+        return -1
+    finally:
+        if not isinstance(target, dict):
+            tables().sets_changed()
+
+    if watch_period != None:
+        start_watch_element_file(name, path, fmt, watch_period)
+    return 0
+
+
+# a copy of target with the elements of the file added or deleted, target is left as is
+def load_elements_copy(target, path, fmt, is_add):
+    target = target.copy()
+    load_elements(target, path, fmt, is_add)
+    return target
+
+
+# cmd_str: "add|delete element NAME file PATH ...", from the control socket
+# the file is loaded into a copy of the set/map in a worker thread, and the copy is swapped in on the loop,
+# so queries are served meanwhile. Commands are run one at a time, nothing else changes the set/map in place
+async def element_file_cmd(cmd_str):
+    cmd = cmd_str.replace(',', '').split()
+    is_add = cmd.pop(0) == "add"
+    name = cmd[1]
+    parsed = parse_element_file(is_add, cmd[3:])
+    if parsed == None:
+        return f"failed to run command: {cmd_str}"
+    path, fmt, watch_period = parsed
+    dnstables = DNSTables.get_instance()
+    targets = dnstables.maps if name in dnstables.maps else dnstables.sets
+    target = targets.get(name)
+    if target == None:
+        log_error(f"unable to find set/map: {name}")
+        return f"failed to run command: {cmd_str}"
+
+    loop = asyncio.get_event_loop()
+    try:
+        loaded = await loop.run_in_executor(None, load_elements_copy, target, path, fmt, is_add)
+    except Exception as e:
+        log_error(f"unable to load elements from {path}: {e}")
+        return f"failed to run command: {cmd_str}"
+    if targets.get(name) is not target:
+        log_error(f"{name} was replaced while loading {path}, by a reload or a watched file")
+        return f"failed to run command: {cmd_str}"
+    targets[name] = loaded
+    if targets is dnstables.sets:
+        dnstables.sets_changed()
+    if watch_period != None:
+        start_watch_element_file(name, path, fmt, watch_period)
+    return None
+
+
+def is_element_file_cmd(cmd_str):
+    cmd = cmd_str.split()
+    return len(cmd) >= 5 and cmd[0] in ["add", "delete"] and cmd[1] == "element" and cmd[3] == "file"
+
+
 def add_del_element(is_add, cmd):
+    if len(cmd) >= 3 and cmd[1] == "file":
+        name = cmd.pop(0)
+        cmd.pop(0)
+        dnstables = tables()
+        if name in dnstables.maps:
+            return add_del_element_file(is_add, name, dnstables.maps[name], cmd)
+        elif name in dnstables.sets:
+            return add_del_element_file(is_add, name, dnstables.sets[name], cmd)
+        log_error(f"unable to find set/map: {name}")
+        return -1
+
     if len(cmd) < 3 or cmd[1] != "{" or cmd[-1] != "}":
-        print("invalid add/delete element syntax")
+        log_error("invalid add/delete element syntax")
         return -1
     name = cmd.pop(0)
     cmd.pop(0)
     cmd.pop(-1)
-    dnstables = DNSTables.get_instance()
+    dnstables = tables()
 
     is_map = False
     target = None
@@ -43,7 +241,7 @@ def add_del_element(is_add, cmd):
     elif name in dnstables.sets:
         target = dnstables.sets[name]
     else:
-         print(f"unable to find set/map: {name}")
+         log_error(f"unable to find set/map: {name}")
          return -1
 
     if is_map: # map
@@ -51,7 +249,7 @@ def add_del_element(is_add, cmd):
             i = 0
             while i < len(cmd):
                 if cmd[i+1] != ":":
-                    print("invalid add element (maps) syntax")
+                    log_error("invalid add element (maps) syntax")
                     return -1
                 target[cmd[i]] = cmd[i+2]
                 i += 3
@@ -65,6 +263,7 @@ def add_del_element(is_add, cmd):
         else:
             for item in cmd:
                 target.discard(item)
+        dnstables.sets_changed()
 
     return 0
 
@@ -73,23 +272,24 @@ def add_del_element(is_add, cmd):
 #      e.g., drop all query from "192.168.0.0/24" -> ["preresolve", "src", "192.168.0.0/24", "drop"]
 def add_del_rule(is_add, cmd):
     hook = cmd.pop(0)
-    dnstables = DNSTables.get_instance()
+    dnstables = tables()
     if hook not in dnstables.chains.keys():
-        print(f"hook {hook} does not exist")
+        log_error(f"hook {hook} does not exist")
         return -1
     rulechain = dnstables.chains[hook]
 
     if not is_add:
         # cmd is the index in rule chain
         if len(cmd) != 2 or cmd[0] != "index" or not cmd[1].isdigit():
-            print("invalid delete rule syntax")
+            log_error("invalid delete rule syntax")
             return -1
         index = int(cmd[1])
         if len(rulechain) < index - 1:
-            print(f"{hook} rulechain has no rule with index {index}")
+            log_error(f"{hook} rulechain has no rule with index {index}")
             return -1
 
         del rulechain[index]
+        dnstables.chain_changed(hook)
         return 0
 
     # add rule
@@ -119,7 +319,7 @@ def add_del_rule(is_add, cmd):
             cmd.pop(0)
 
         if pending_or:
-            print("invalid matcher after 'or'")
+            log_error("invalid matcher after 'or'")
             return -1
         if final_matcher != None:
             rule.add_matcher(final_matcher)
@@ -142,17 +342,17 @@ def add_del_rule(is_add, cmd):
             if len(cmd) > 0 and cmd[0].isdigit():
                 index = int(cmd.pop(0))
             else:
-                print("invalid 'index' syntax")
+                log_error("invalid 'index' syntax")
                 return -1
 
         # return error if nothing consumed this run
         if len(cmd) == cmd_len:
-            print(f"failed to parse cmd at {' '.join(cmd)}")
+            log_error(f"failed to parse cmd at {' '.join(cmd)}")
             return -1
         cmd_len = len(cmd)
 
     if not has_action:
-        print("require at least one action")
+        log_error("require at least one action")
         return -1
 
     # insert rule
@@ -163,15 +363,16 @@ def add_del_rule(is_add, cmd):
         index = len(rulechain) - 1
     rule.hook = hook
     rule.index = index
+    dnstables.chain_changed(hook)
     return 0
 
 
 def add_del_chain(is_add, cmd):
     if len(cmd) != 1:
-        print("invalid add/delete chain syntax")
+        log_error("invalid add/delete chain syntax")
         return -1
     name = cmd[0]
-    dnstables = DNSTables.get_instance()
+    dnstables = tables()
 
     if is_add and name not in dnstables.hooks:
         dnstables.hooks.append(name)
@@ -179,6 +380,7 @@ def add_del_chain(is_add, cmd):
     elif not is_add and name in dnstables.chains.keys():
         dnstables.hooks.remove(name)
         dnstables.chains.pop(name, None)
+        dnstables.chain_changed(name)
     return 0
 
 
@@ -198,15 +400,358 @@ def cmd(cmd_str):
     elif cmd[0] == "rule":
         cmd.pop(0)
         ret = add_del_rule(is_add, cmd)
+        prune_zones()
     elif cmd[0] == "element":
         cmd.pop(0)
         ret = add_del_element(is_add, cmd)
     elif cmd[0] == "chain":
         cmd.pop(0)
         ret = add_del_chain(is_add, cmd)
+        prune_zones()
     else:
         return f"unknown keyword {cmd[0]}"
 
     if ret != 0:
         return f"failed to run command: {cmd_str}"
     return None
+
+
+# zones are shared by the rules resolving from the same file, and dropped along with the last of them,
+# or when the rule using them failed to parse. Staged tables are pruned once applied
+def prune_zones():
+    if tables() is not DNSTables.get_instance():
+        return
+    used = {action.zone_file for rules in DNSTables.get_instance().chains.values() for rule in rules
+            for action in rule.actions if isinstance(action, ResolveZoneAction)}
+    for path in [path for path in zones if path not in used]:
+        del zones[path]
+
+
+def iter_rulefile(path):
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip() # remove leading spaces
+            if not line or line.startswith("#"): # skip comments
+                continue
+            yield line
+
+
+# runs in a worker thread: build fresh tables from the rulefile, and find the sets/maps that differ from the live ones
+# live sets/maps are only read here, a concurrent change is caught again when the plan is applied
+def stage_rulefile(path):
+    staged = DNSTables()
+    _staging.tables = staged
+    try:
+        for line in iter_rulefile(path):
+            err = cmd(line)
+            if err != None:
+                raise ValueError(err)
+    finally:
+        _staging.tables = None
+
+    live = DNSTables.get_instance()
+    unchanged = []
+    for kind in ["sets", "maps"]:
+        live_targets = getattr(live, kind)
+        for name, target in getattr(staged, kind).items():
+            current = live_targets.get(name)
+            try:
+                if current == target:
+                    unchanged.append((kind, name, current))
+            except RuntimeError: # changed size during comparison
+                pass
+    return staged, unchanged
+
+
+# rules whose text is unchanged are kept, with their counters and state (rate limit buckets, slip counters...)
+def merge_chain(hook, live_rules, staged_rules):
+    reusable = dict()
+    for rule in live_rules:
+        reusable.setdefault(str(rule), []).append(rule)
+    merged = []
+    kept = 0
+    for index, rule in enumerate(staged_rules):
+        same = reusable.get(str(rule))
+        if same:
+            rule = same.pop(0)
+            kept += 1
+        rule.hook = hook
+        rule.index = index
+        merged.append(rule)
+    return merged, kept
+
+
+# swap in what changed, on the loop, with no await in between so queries never see a half applied reload
+def apply_staged(staged, unchanged):
+    live = DNSTables.get_instance()
+    unchanged = {(kind, name) for kind, name, target in unchanged if getattr(live, kind).get(name) is target}
+    summary = []
+
+    for kind in ["sets", "maps"]:
+        live_targets = getattr(live, kind)
+        staged_targets = getattr(staged, kind)
+        changed = [name for name in staged_targets if (kind, name) not in unchanged]
+        removed = [name for name in live_targets if name not in staged_targets]
+        for name in changed:
+            live_targets[name] = staged_targets[name]
+        for name in removed:
+            del live_targets[name]
+        if kind == "sets" and len(changed) + len(removed) > 0:
+            live.sets_changed()
+        summary.append(f"{kind}: {len(changed)} changed, {len(removed)} removed")
+
+    changed = 0
+    kept = 0
+    new_chains = dict()
+    for hook in staged.hooks:
+        live_rules = live.chains.get(hook, [])
+        staged_rules = staged.chains[hook]
+        if [str(rule) for rule in live_rules] == [str(rule) for rule in staged_rules]:
+            new_chains[hook] = live_rules
+            kept += len(live_rules)
+            continue
+        new_chains[hook], chain_kept = merge_chain(hook, live_rules, staged_rules)
+        kept += chain_kept
+        changed += 1
+        live.chain_changed(hook)
+    removed = [hook for hook in live.hooks if hook not in new_chains]
+    for hook in removed:
+        live.chain_changed(hook)
+    live.chains = new_chains
+    live.hooks = list(staged.hooks)
+    rules = sum(len(rules) for rules in new_chains.values())
+    summary.append(f"chains: {changed} changed, {len(removed)} removed, {kept}/{rules} rules kept")
+
+    restarted = 0
+    for name in list(live.watch_specs):
+        if name not in staged.watch_specs:
+            stop_watch_element_file(name)
+    for name, spec in staged.watch_specs.items():
+        if live.watch_specs.get(name) != spec:
+            start_watch_element_file(name, *spec)
+            restarted += 1
+    summary.append(f"watchers: {restarted} started")
+    return "; ".join(summary)
+
+
+reloading = False
+
+async def reload(path):
+    global reloading
+    if path == None:
+        return "no rulefile to reload"
+    if reloading:
+        return "a reload is already in progress"
+    reloading = True
+    loop = asyncio.get_event_loop()
+    try:
+        staged, unchanged = await loop.run_in_executor(None, stage_rulefile, path)
+    except (OSError, ValueError) as e:
+        prune_zones() # loaded for the staged rules only
+        return f"failed to reload {path}, rules are unchanged: {e}"
+    finally:
+        reloading = False
+    summary = apply_staged(staged, unchanged)
+    prune_zones()
+    return f"reloaded {path}: " + summary
+
+
+# chain dispatch indexes are left out, they are rebuilt on first use (see DNSTables.chain_rules)
+snapshot_fields = ["sets", "maps", "hooks", "chains", "set_generation", "watch_specs"]
+
+# cmd_str: "compile FILE"
+# dump the parsed tables and loaded zones, for server.py --snapshot
+def compile_snapshot(cmd_str):
+    cmd = cmd_str.split()
+    if len(cmd) != 2:
+        return "invalid compile syntax, expecting 'compile FILE'"
+    path = cmd[1]
+    dnstables = DNSTables.get_instance()
+    payload = {name: getattr(dnstables, name) for name in snapshot_fields}
+    payload["zones"] = zones
+    try:
+        size = write_snapshot(path, payload)
+    except (OSError, pickle.PicklingError) as e:
+        return f"failed to write snapshot {path}: {e}"
+    rules = sum(len(rules) for rules in dnstables.chains.values())
+    return f"compiled {len(dnstables.hooks)} chains, {rules} rules, {len(dnstables.sets)} sets, {len(dnstables.maps)} maps into {path} ({size} bytes)"
+
+
+# replaces the live tables, returns an error string or None
+def load_snapshot(path):
+    try:
+        payload = read_snapshot(path)
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError, AttributeError, ImportError) as e:
+        return f"failed to load snapshot {path}: {e}"
+    dnstables = DNSTables.get_instance()
+    for name in snapshot_fields:
+        setattr(dnstables, name, payload[name])
+    dnstables.chain_indexes.clear()
+    dnstables.memo.clear()
+    zones.update(payload["zones"])
+    for rules in dnstables.chains.values():
+        for rule in rules:
+            rule.reset_counters()
+    for name, spec in list(dnstables.watch_specs.items()):
+        start_watch_element_file(name, *spec)
+    return None
+
+
+def stats_dict():
+    dnstables = DNSTables.get_instance()
+    dnst_stats = DNSTStats.get_instance()
+    health = DNSTUpstreams.get_instance().upstreams
+    chains = dict()
+    for hook in dnstables.hooks:
+        chains[hook] = {
+            "latency": dnst_stats.chain_latency[hook].to_dict() if hook in dnst_stats.chain_latency else None,
+            "rules": [{
+                "index": index,
+                "rule": str(rule),
+                "packets": rule.packets,
+                "bytes": rule.bytes,
+                "time_ns": rule.time_ns,
+            } for index, rule in enumerate(dnstables.chains[hook])],
+        }
+    return {
+        "loop": DNSTWatchdog.get_instance().stats(),
+        "chains": chains,
+        "actions": {name: hist.to_dict() for name, hist in dnst_stats.action_latency.items()},
+        "upstreams": {name: dict(upstream.to_dict(), health = health[name].stats() if name in health else None)
+                      for name, upstream in dnst_stats.upstreams.items()},
+        "admission": DNSTAdmission.get_instance().stats(),
+        "cache": DNSTCache.get_instance().stats(),
+        "fakeip": {net: pool.stats() for net, pool in fake_ip_pools.items()},
+        "nftset": DNSTNftSets.get_instance().stats(),
+        "zones": {path: zone.stats() for path, zone in zones.items()},
+        "sets": {name: target.stats() if isinstance(target, CompactSet) else {"elements": len(target), "compact": False}
+                 for name, target in dnstables.sets.items()},
+        "logger": DNSTLogger.get_instance().stats(),
+        "querylog": DNSTQueryLog.get_instance().stats() if DNSTQueryLog.get_instance() != None else None,
+    }
+
+
+def stats_prometheus():
+    dnstables = DNSTables.get_instance()
+    dnst_stats = DNSTStats.get_instance()
+    writer = PrometheusWriter()
+    watchdog = DNSTWatchdog.get_instance()
+    writer.histogram("loop_lag_seconds", watchdog.lag)
+    writer.counter("loop_stalls_total", watchdog.stalls)
+    rules = [(hook, index, rule) for hook in dnstables.hooks for index, rule in enumerate(dnstables.chains[hook])]
+    for name in ["packets", "bytes"]:
+        for hook, index, rule in rules:
+            writer.counter(f"rule_{name}_total", getattr(rule, name), chain = hook, index = index, rule = rule)
+    for hook, index, rule in rules:
+        writer.counter("rule_seconds_total", rule.time_ns / 1e9, chain = hook, index = index, rule = rule)
+    for hook, hist in dnst_stats.chain_latency.items():
+        writer.histogram("chain_latency_seconds", hist, chain = hook)
+    for name, hist in dnst_stats.action_latency.items():
+        writer.histogram("action_latency_seconds", hist, action = name)
+    for name in ["queries", "timeouts", "errors", "servfail", "skipped", "tcp_retries"]:
+        for upstream, upstream_stats in dnst_stats.upstreams.items():
+            writer.counter(f"upstream_{name}_total", getattr(upstream_stats, name), upstream = upstream)
+    for upstream, health in DNSTUpstreams.get_instance().upstreams.items():
+        writer.gauge("upstream_up", 0 if health.is_open else 1, upstream = upstream)
+    for upstream, health in DNSTUpstreams.get_instance().upstreams.items():
+        writer.gauge("upstream_timeout_seconds", health.timeout(), upstream = upstream)
+    for upstream, upstream_stats in dnst_stats.upstreams.items():
+        writer.histogram("upstream_rtt_seconds", upstream_stats.rtt, upstream = upstream)
+    admission = DNSTAdmission.get_instance().stats()
+    for name in ["inflight", "queued_now"]:
+        writer.gauge(f"admission_{name}", admission[name])
+    for name in ["admitted", "queued", "shed_queue_full", "shed_expired"]:
+        writer.counter(f"admission_{name}_total", admission[name])
+    cache_views = DNSTCache.get_instance().stats()["views"]
+    for name in ["hits", "misses", "evictions"]:
+        for view, view_stats in cache_views.items():
+            writer.counter(f"cache_{name}_total", view_stats[name], view = view)
+    for view, view_stats in cache_views.items():
+        writer.gauge("cache_entries", view_stats["entries"], view = view)
+    logger_stats = DNSTLogger.get_instance().stats()
+    for name in ["written", "dropped", "sampled_out"]:
+        writer.counter(f"logger_{name}_total", logger_stats[name])
+    for name in ["size", "used"]:
+        for net, pool in fake_ip_pools.items():
+            writer.gauge(f"fakeip_pool_{name}", pool.stats()[name], net = net)
+    nftset_stats = DNSTNftSets.get_instance().stats()
+    for name in ["queued", "deduped", "dropped", "added", "errors"]:
+        writer.counter(f"nftset_{name}_total", nftset_stats[name])
+    for path, zone in zones.items():
+        writer.gauge("zone_names", len(zone.records), zone = path)
+    for path, zone in zones.items():
+        writer.counter("zone_loads_total", zone.loads, zone = path)
+    return str(writer)
+
+
+def stats_reset():
+    dnstables = DNSTables.get_instance()
+    for rulechain in dnstables.chains.values():
+        for rule in rulechain:
+            rule.reset_counters()
+    DNSTStats._instance = None
+    DNSTCache.get_instance().reset_stats()
+    DNSTWatchdog.get_instance().reset_stats()
+    DNSTAdmission.get_instance().reset_stats()
+    DNSTNftSets.get_instance().reset_stats()
+    DNSTLogger.get_instance().reset_stats()
+    if DNSTQueryLog.get_instance() != None:
+        DNSTQueryLog.get_instance().reset_stats()
+
+
+# cmd_str: "stats [json|prometheus|reset]"
+def stats(cmd_str):
+    cmd = cmd_str.split()
+    fmt = cmd[1] if len(cmd) > 1 else "json"
+    if fmt == "json":
+        return json.dumps(stats_dict(), indent = 2)
+    elif fmt == "prometheus":
+        return stats_prometheus()
+    elif fmt == "reset":
+        stats_reset()
+        return None
+    return f"unknown stats format {fmt}"
+
+
+# cmd_str: "profile on|off", "profile show [COUNT]", "profile sample SECONDS FILE"
+def profile(cmd_str):
+    cmd = cmd_str.split()
+    profiler = DNSTProfiler.get_instance()
+    if cmd[1:] == ["on"]:
+        profiler.enabled = True
+    elif cmd[1:] == ["off"]:
+        profiler.enabled = False
+    elif len(cmd) in [2, 3] and cmd[1] == "show":
+        count = int(cmd[2]) if len(cmd) == 3 and cmd[2].isdigit() else len(profiler.timelines)
+        timelines = list(profiler.timelines)[-count:] if count > 0 else []
+        return "\n".join(json.dumps(timeline) for timeline in timelines)
+    elif len(cmd) == 4 and cmd[1] == "sample" and cmd[2].isdigit():
+        if not profiler.start_sampling(int(cmd[2]), cmd[3]):
+            return "sampling profiler is already running"
+        return f"sampling for {cmd[2]} seconds into {cmd[3]}"
+    else:
+        return "invalid profile syntax"
+    return None
+
+
+# cmd_str: "top [qnames|clients|nxdomain|latency] [N]" or "top reset"
+def top(cmd_str):
+    cmd = cmd_str.split()[1:]
+    heavy_hitters = DNSTHeavyHitters.get_instance()
+    if cmd == ["reset"]:
+        heavy_hitters.reset()
+        return None
+    if not heavy_hitters.enabled:
+        return "heavy hitters are disabled (--topsize 0)"
+    count = 10
+    if len(cmd) > 0 and cmd[-1].isdigit():
+        count = int(cmd.pop())
+    kinds = heavy_hitters.kinds
+    if len(cmd) == 1 and cmd[0] in heavy_hitters.kinds:
+        kinds = cmd
+    elif len(cmd) > 0:
+        return "invalid top syntax, expecting 'top [qnames|clients|nxdomain|latency] [N]' or 'top reset'"
+    return json.dumps({
+        "half_life": heavy_hitters.half_life,
+        "tops": {kind: heavy_hitters.top(kind, count) for kind in kinds},
+    }, indent = 2)
@@ -1,7 +1,9 @@
 from dataclasses import dataclass
 from fnmatch import fnmatch
-import ipaddress
-from dnst_core import DNSTables, DNSTQuery, Trace
+from collections import OrderedDict
+import time
+from dnst_core import DNSTables, DNSTQuery, Trace, log_error
+from utils.ipv4 import IPv4Set, parse_network
 
 
 class DNSTMatcher(Trace.with_name("matcher")):
@@ -15,6 +17,21 @@ class DNSTMatcher(Trace.with_name("matcher")):
     def _match(self, query, **kwargs):
         return True # match everything
 
+    # keys for the chain dispatch index: a query can only match if one of the keys matches it
+    # returns a set of ("exact", qname), ("suffix", qname suffix) or ("src", (prefixlen, network))
+    # None if this matcher can't be indexed
+    def index_keys(self):
+        return None
+
+    # query properties the result depends on, among "qname", "src", "src_port", "answer"
+    # and "state" for matchers with side effects
+    def depends(self):
+        return frozenset()
+
+    # and-ed sub matchers
+    def conjuncts(self):
+        return [self]
+
     def msg_decor(self, msg):
         return f"matcher=\"{self}\"\tmsg=\"{msg}\""
 
@@ -27,6 +44,9 @@ class NotMatcher(DNSTMatcher):
     def _match(self, query, **kwargs):
         return not self.matcher.match(query, **kwargs)
 
+    def depends(self):
+        return self.matcher.depends()
+
     def __str__(self):
         return f"not {self.matcher}"
 
@@ -38,6 +58,16 @@ class AndMatcher(DNSTMatcher):
     def _match(self, query, **kwargs):
         return self.matcher0.match(query, **kwargs) and self.matcher1.match(query, **kwargs)
 
+    # matcher1 is only evaluated if matcher0 matches
+    def index_keys(self):
+        return self.matcher0.index_keys()
+
+    def depends(self):
+        return self.matcher0.depends() | self.matcher1.depends()
+
+    def conjuncts(self):
+        return self.matcher0.conjuncts() + self.matcher1.conjuncts()
+
     def __str__(self):
         return f"{self.matcher0} {self.matcher1}"
 
@@ -49,6 +79,16 @@ class OrMatcher(DNSTMatcher):
     def _match(self, query, **kwargs):
         return self.matcher0.match(query, **kwargs) or self.matcher1.match(query, **kwargs)
 
+    def index_keys(self):
+        keys0 = self.matcher0.index_keys()
+        keys1 = self.matcher1.index_keys()
+        if keys0 == None or keys1 == None:
+            return None
+        return keys0 | keys1
+
+    def depends(self):
+        return self.matcher0.depends() | self.matcher1.depends()
+
     def __str__(self):
         return f"{self.matcher0} or {self.matcher1}"
 
@@ -74,10 +114,10 @@ class QnameMatcher(DNSTMatcher):
         # match sets
         if self.qname_matcher.startswith("@"):
             try:
-                match_set = DNSTables.get_instance().sets[query_matcher[1:]]
-                return self._qname_match_set(qname, match_set, query)
+                match_set = DNSTables.get_instance().sets[self.qname_matcher[1:]]
+                return self._qname_match_set(query, qname, match_set)
             except KeyError: # set does not exist
-                print(f"[{obj.__class__.__name__}]: cannot find set '{self.qname_matcher}'")
+                self.warn(query, f"cannot find set '{self.qname_matcher}'")
                 return False
         # match single domain or wildcard domain
         else:
@@ -85,6 +125,19 @@ class QnameMatcher(DNSTMatcher):
                 return True
         return False
 
+    def index_keys(self):
+        if self.qname_matcher.startswith("@"):
+            return None
+        if not any(c in self.qname_matcher for c in "*?["):
+            return frozenset([("exact", self.qname_matcher)])
+        suffix = self.qname_matcher[2:]
+        if self.qname_matcher.startswith("*.") and not any(c in suffix for c in "*?["):
+            return frozenset([("suffix", suffix)])
+        return None
+
+    def depends(self):
+        return frozenset(["qname"])
+
     def __str__(self):
         return f"qname {self.qname_matcher}"
 
@@ -92,60 +145,48 @@ class QnameMatcher(DNSTMatcher):
 @dataclass
 class IPMatcher(DNSTMatcher):
     ip_matcher: str # "192.168.0.1" / "192.168.0.0/24" / "@example_set"
-    key: str # "src" / "answer"
-    # ip: a single ip in str
-    # match ip with match_set
-    def _ip_match_set(self, ip, match_set):
-        # exact match
-        if ip in match_set:
-            return True
-
-        # check for networks
-        # e.g., ip = "192.168.0.1", look for "192.168.0.0/24", "192.168.0.0/23", etc
-        # fast path
-        if not hasattr(self, "cache_matched"):
-            setattr(self, "cache_matched", dict())
-            self.cache_matched[True] = set()
-            self.cache_matched[False] = set()
-        for ret in [True, False]:
-            if ip in self.cache_matched[ret]:
-                return ret
-
-        # slow path (hopefully the set won't be too huge)
-        # TODO: maybe try pytricia?
-        if not hasattr(self, "net_list"):
-            networks = [ipaddress.IPv4Network(network) for network in match_set]
-            setattr(self, "net_list", list(ipaddress.collapse_addresses(networks)))
-        ipa = ipaddress.IPv4Address(ip)
-        matched = any(ipa in net for net in self.net_list)
-        self.cache_matched[matched].add(ip)
-        return matched
-
-    # ip: a single ip in str
+    key: str # "src" / "anyanswer" / "everyanswer"
+
+    def __post_init__(self):
+        # (network, prefixlen) of a single ip or net, None for sets
+        self.network = None if self.ip_matcher.startswith("@") else parse_network(self.ip_matcher)
+
+    # the set as an IPv4Set, rebuilt whenever a set changes, None if the set does not exist
+    def _ip_set(self):
+        generation = DNSTables.get_instance().set_generation
+        if getattr(self, "set_generation", None) != generation:
+            match_set = DNSTables.get_instance().sets.get(self.ip_matcher[1:])
+            self.ip_set = IPv4Set(match_set) if match_set != None else None
+            self.set_generation = generation
+        return self.ip_set
+
+    # ip: a single ip as int
     # match ip with self.ip_matcher
     def _ip_match(self, ip):
-        # match sets
-        if self.ip_matcher.startswith("@"):
-            try:
-                match_set = DNSTables.get_instance().sets[self.ip_matcher[1:]]
-                return self._ip_match_set(ip, match_set)
-            except KeyError: # set does not exist
-                print(f"[{obj.__class__.__name__}]: cannot find set '{self.ip_matcher}'")
-                return False
         # match single ip or net
-        else:
-            ipa = ipaddress.IPv4Address(ip)
-            net = ipaddress.IPv4Network(self.ip_matcher)
-            return ipa in net
+        if self.network != None:
+            network, prefixlen = self.network
+            return ip >> (32 - prefixlen) == network >> (32 - prefixlen)
+        # match sets
+        ip_set = self._ip_set()
+        if ip_set == None:
+            log_error(f"[{self.__class__.__name__}]: cannot find set '{self.ip_matcher}'")
+            return False
+        return ip in ip_set
 
-    def _match(self, query, src, answer, **kwargs):
+    # set derived data is rebuilt on first use
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("set_generation", None)
+        state.pop("ip_set", None)
+        return state
+
+    def _match(self, query, src_ip, answer, **kwargs):
         if self.key == "src":
-            if self._ip_match(src):
-                return True
-            return False
+            return self._ip_match(src_ip)
 
         # self.key in ["anyanswer", "everyanswer"]:
-        if not query.has_answer:
+        if not query.has_answer():
             return False
         elif self.key == "anyanswer":
             #self.debug(query, f"any_list = {}")
@@ -155,6 +196,15 @@ class IPMatcher(DNSTMatcher):
         else:
             return False
 
+    def index_keys(self):
+        if self.key != "src" or self.network == None:
+            return None
+        network, prefixlen = self.network
+        return frozenset([("src", (prefixlen, network >> (32 - prefixlen)))])
+
+    def depends(self):
+        return frozenset(["src" if self.key == "src" else "answer"])
+
     def __str__(self):
         return f"{self.key} {self.ip_matcher}"
 
@@ -165,6 +215,9 @@ class SrcPortMatcher(DNSTMatcher):
     def _match(self, query, src_port, **kwargs):
         return src_port == self.src_port
 
+    def depends(self):
+        return frozenset(["src_port"])
+
     def __str__(self):
         return f"srcport {self.src_port}"
 
@@ -174,20 +227,104 @@ class HasAnswerMatcher(DNSTMatcher):
     def _match(self, query, **kwargs):
         return query.has_answer()
 
+    def depends(self):
+        return frozenset(["answer"])
+
     def __str__(self):
         return f"hasanswer"
 
 
+@dataclass
+class LimitMatcher(DNSTMatcher):
+    rate: int # queries per unit
+    unit: str # "second" / "minute" / "hour"
+    over: bool # match queries over the rate instead of under it
+    burst: int
+    per: str # None / "src" / "src/24"
+    max_keys: int = 65536
+
+    unit_seconds = {"second": 1, "minute": 60, "hour": 3600}
+
+    def __post_init__(self):
+        self.interval = self.unit_seconds[self.unit] / self.rate
+        self.prefixlen = int(self.per.split("/")[1]) if self.per != None and "/" in self.per else 32
+        # token bucket per key, stored as its "theoretical arrival time" (GCRA)
+        # i.e. the time the bucket will be full again, a single float per key
+        # LRU ordered so that memory is bounded by max_keys
+        self.buckets = OrderedDict()
+
+    # buckets are runtime state, not part of a snapshot
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["buckets"] = OrderedDict()
+        return state
+
+    def _key(self, src_ip):
+        if self.per == None:
+            return None
+        return src_ip >> (32 - self.prefixlen)
+
+    # consume one token, return False if the bucket is empty
+    def _conform(self, key):
+        now = time.monotonic()
+        tat = self.buckets.get(key, now)
+        if tat < now:
+            tat = now
+        if tat + self.interval - now > self.burst * self.interval:
+            self.buckets.move_to_end(key)
+            return False
+        self.buckets[key] = tat + self.interval
+        self.buckets.move_to_end(key)
+        if len(self.buckets) > self.max_keys:
+            # evicting the least recently seen key only forgets a (mostly) refilled bucket
+            self.buckets.popitem(last = False)
+        return True
+
+    def _match(self, query, src_ip, **kwargs):
+        conform = self._conform(self._key(src_ip))
+        return not conform if self.over else conform
+
+    def depends(self):
+        return frozenset(["src", "state"])
+
+    def __str__(self):
+        ret = "limit rate"
+        if self.over:
+            ret += " over"
+        ret += f" {self.rate}/{self.unit} burst {self.burst}"
+        if self.per != None:
+            ret += f" per {self.per}"
+        return ret
+
+
 class DNSTMatcherBuilder:
     # cmd is a list of words such as ["src", "192.168.0.0/24", ...]
     # this method consumes the valid words and returns the matcher
     @classmethod
     def build(cls, cmd):
+        ret = cls.build_one(cmd)
+        if ret == None:
+            return None
+
+        # if there are more matchers, they should be and-ed
+        next_matcher = cls.build(cmd)
+        if next_matcher != None:
+            return AndMatcher(matcher0 = ret, matcher1 = next_matcher)
+        return ret
+
+    # build a single matcher, "not" only applies to the matcher right after it
+    @classmethod
+    def build_one(cls, cmd):
         if len(cmd) == 0:
             return None
         elif cmd[0] == "not":
+            if len(cmd) < 2:
+                return None
             cmd.pop(0)
-            ret = NotMatcher(matcher = cls.build(cmd))
+            matcher = cls.build_one(cmd)
+            if matcher == None:
+                return None
+            ret = NotMatcher(matcher = matcher)
         elif cmd[0] == "hasanswer":
             cmd.pop(0)
             ret = HasAnswerMatcher()
@@ -203,14 +340,51 @@ class DNSTMatcherBuilder:
             src_port = cmd.pop(0)
             ret = SrcPortMatcher(src_port = src_port)
         elif cmd[0] in ["src", "anyanswer", "everyanswer"]:
+            if not cmd[1].startswith("@"):
+                try:
+                    parse_network(cmd[1])
+                except ValueError:
+                    return None
             key = cmd.pop(0)
             ip_matcher = cmd.pop(0)
             ret = IPMatcher(ip_matcher = ip_matcher, key = key)
+        elif cmd[0] == "limit":
+            ret = cls.build_limit(cmd)
         else:
             return None
-
-        # if there are more matchers, they should be and-ed
-        next_matcher = cls.build(cmd)
-        if next_matcher != None:
-            return AndMatcher(matcher0 = ret, matcher1 = next_matcher)
         return ret
+
+    # cmd: ["limit", "rate", ["over"], "N/UNIT", ["burst", "M"], ["per", "src[/LEN]"], ...]
+    # only consumes words if the whole limit statement is valid
+    @classmethod
+    def build_limit(cls, cmd):
+        i = 2
+        if cmd[:2] != ["limit", "rate"]:
+            return None
+        over = len(cmd) > i and cmd[i] == "over"
+        if over:
+            i += 1
+        if len(cmd) <= i or cmd[i].count("/") != 1:
+            return None
+        rate, unit = cmd[i].split("/")
+        if not rate.isdigit() or int(rate) == 0 or unit not in LimitMatcher.unit_seconds:
+            return None
+        i += 1
+
+        burst = 5
+        if len(cmd) > i + 1 and cmd[i] == "burst":
+            if not cmd[i + 1].isdigit() or int(cmd[i + 1]) == 0:
+                return None
+            burst = int(cmd[i + 1])
+            i += 2
+
+        per = None
+        if len(cmd) > i + 1 and cmd[i] == "per":
+            per = cmd[i + 1]
+            if per != "src":
+                if not per.startswith("src/") or not per[4:].isdigit() or int(per[4:]) > 32:
+                    return None
+            i += 2
+
+        del cmd[:i]
+        return LimitMatcher(rate = int(rate), unit = unit, over = over, burst = burst, per = per)
@@ -1,13 +1,21 @@
 import asyncio
 import os
-import sys
+import time
 import signal
 import argparse
 import ipaddress
 from dnslib import DNSRecord, RR, QTYPE, A, RCODE
-from dnst_engine import cmd
+from dnst_engine import cmd, stats, profile, top, reload, iter_rulefile, compile_snapshot, load_snapshot, \
+    is_element_file_cmd, element_file_cmd
 from dnst_core import DNSTables, DNSTQuery, log, Trace
 from utils.cache import DNSTCache
+from utils.profiler import DNSTProfiler
+from utils.logger import DNSTLogger
+from utils.querylog import DNSTQueryLog
+from utils.heavy_hitters import DNSTHeavyHitters
+from utils.watchdog import DNSTWatchdog
+from utils import edns
+from utils.admission import DNSTAdmission, parse_question
 
 
 args = None
@@ -20,11 +28,21 @@ def extract_query_info(query_data):
         qtype = QTYPE[request.q.qtype]
         return request, qname, qtype
     except Exception as e:
-        print(f"[ERROR] Failed to parse query: {e}")
+        DNSTLogger.get_instance().log(f"[ERROR] Failed to parse query: {e}")
         return None, None, None
 
 
+# outcome of a query, for the query log and the heavy hitters
+def record_query(start, src, src_port, qname, qtype, verdict, answer, rule):
+    DNSTHeavyHitters.get_instance().observe(src, qname, verdict)
+    querylog = DNSTQueryLog.get_instance()
+    if querylog != None:
+        querylog.write((time.time_ns(), time.perf_counter_ns() - start, src, src_port,
+                        qname, qtype, verdict, answer, rule))
+
+
 async def handle_dns_query(data, addr, sock):
+    start = time.perf_counter_ns()
     request, qname, qtype = extract_query_info(data)
     if qname == None:
         return
@@ -32,8 +50,10 @@ async def handle_dns_query(data, addr, sock):
 
     # FIXME: only works for A record
     if qtype != "A":
+        reply.header.aa = 0
         reply.header.rcode = RCODE.NXDOMAIN
-        sock.sendto(reply.pack(), addr)
+        sock.sendto(edns.pack_reply(request, reply), addr)
+        record_query(start, addr[0], addr[1], qname, request.q.qtype, "nxdomain", [], None)
         return
 
     # feed into dnstables
@@ -45,40 +65,122 @@ async def handle_dns_query(data, addr, sock):
             raw_query = data,
             verbose = Trace.verbose_lvl[args.verbose],
     )
+    profiler = DNSTProfiler.get_instance()
+    if profiler.enabled:
+        dnst_query.timeline = []
+        dnst_query.profile("parse", start)
     ret = await DNSTables.get_instance().feed(dnst_query)
     if ret == "drop":
+        record_query(start, dnst_query.src, dnst_query.src_port, qname, request.q.qtype,
+                       "drop", [], dnst_query.answered_by)
         return
 
     # reply
-    if dnst_query.has_answer():
+    encode_start = time.perf_counter_ns()
+    # dnslib replies default to aa=1, only answers from local zones are authoritative
+    reply.header.aa = 1 if dnst_query.authoritative else 0
+    if ret == "truncate":
+        reply.header.tc = 1
+    elif dnst_query.has_answer():
         for ip, ttl in dnst_query.answer:
-            reply.add_answer(RR(qname, QTYPE.A, rdata=A(ip), ttl=ttl))
-    else:
+            reply.add_answer(RR(qname, QTYPE.A, rdata=A(tuple(ip.to_bytes(4, "big"))), ttl=ttl))
+    elif not dnst_query.nodata:
         reply.header.rcode = RCODE.NXDOMAIN
-    sock.sendto(reply.pack(), (dnst_query.src, dnst_query.src_port))
+    reply_data = edns.pack_reply(request, reply)
+    dnst_query.profile("encode", encode_start)
+    send_start = time.perf_counter_ns()
+    sock.sendto(reply_data, (dnst_query.src, dnst_query.src_port))
+    dnst_query.profile("send", send_start)
+    if dnst_query.timeline != None:
+        profiler.record(dnst_query, start)
+    record_query(start, dnst_query.src, dnst_query.src_port, qname, request.q.qtype,
+                   "truncate" if reply.header.tc else "nxdomain" if reply.header.rcode == RCODE.NXDOMAIN else "reply",
+                   dnst_query.answer if not reply.header.tc else [], dnst_query.answered_by)
     return
 
 
 class DNSDatagramProtocol:
     def connection_made(self, sock):
         self.sock = sock
-        print(f"DNS Server is listening on UDP/{args.listen}:{args.port}")
+        self.sweep = None # timer shedding the queued queries that expire
+        asyncio.ensure_future(log(f"DNS Server is listening on UDP/{args.listen}:{args.port}"))
 
     def connection_lost(self, exc):
-        print(f"Connection lost: {exc}")
+        asyncio.ensure_future(log(f"Connection lost: {exc}"))
 
     def datagram_received(self, data, addr):
-        asyncio.ensure_future(handle_dns_query(data, addr, self.sock))
-
+        verdict, displaced = DNSTAdmission.get_instance().submit((data, addr), lambda: is_cached(data))
+        if verdict == "run":
+            self.handle(data, addr)
+        elif verdict == "shed":
+            self.shed(data, addr)
+        elif self.sweep == None:
+            self.schedule_sweep()
+        if displaced != None:
+            self.shed(*displaced)
+
+    def handle(self, data, addr):
+        task = asyncio.ensure_future(handle_dns_query(data, addr, self.sock))
+        task.add_done_callback(self.handled)
+
+    def handled(self, task):
+        item, expired = DNSTAdmission.get_instance().done()
+        for data, addr in expired:
+            self.shed(data, addr)
+        if item != None:
+            self.handle(*item)
+
+    def schedule_sweep(self):
+        delay = DNSTAdmission.get_instance().next_expiry()
+        if delay != None:
+            self.sweep = asyncio.get_event_loop().call_later(delay, self.sweep_expired)
+
+    def sweep_expired(self):
+        self.sweep = None
+        for data, addr in DNSTAdmission.get_instance().expire():
+            self.shed(data, addr)
+        self.schedule_sweep()
+
+    def shed(self, data, addr):
+        reply = DNSTAdmission.get_instance().shed_reply(data)
+        if reply != None:
+            self.sock.sendto(reply, addr)
+
+
+# queries that can be answered from cache are admitted first when overloaded
+def is_cached(data):
+    question = parse_question(data)
+    return question != None and question[1] == QTYPE.A and DNSTCache.get_instance().contains(question[0], "A")
+
+
+# commands that change the tables run one at a time, an element file loading in a worker thread
+# must not see its set/map changed meanwhile
+cmd_lock = asyncio.Lock()
 
 async def handle_cmd(reader, writer):
-    data = await reader.read(1024)
+    # read until the client shuts down its write side, commands are not size limited
+    data = await reader.read()
     cmd_str = data.decode()
 
     if cmd_str == "list":
         ret = str(DNSTables.get_instance())
+    elif cmd_str.split()[:1] == ["stats"]:
+        ret = stats(cmd_str)
+    elif cmd_str.split()[:1] == ["profile"]:
+        ret = profile(cmd_str)
+    elif cmd_str.split()[:1] == ["top"]:
+        ret = top(cmd_str)
+    elif cmd_str.split()[:1] == ["reload"]:
+        async with cmd_lock:
+            ret = await reload(args.rulefile)
+    elif cmd_str.split()[:1] == ["compile"]:
+        ret = compile_snapshot(cmd_str)
+    elif is_element_file_cmd(cmd_str):
+        async with cmd_lock:
+            ret = await element_file_cmd(cmd_str)
     else:
-        ret = cmd(cmd_str)
+        async with cmd_lock:
+            ret = cmd(cmd_str)
 
     if ret == None:
         ret = "ok"
@@ -89,16 +191,44 @@ async def handle_cmd(reader, writer):
 
 
 async def main():
-    # redirect to log file
-    f = None
-    if args.logfile != None:
+    try:
+        logger = DNSTLogger.configure(
+                path = args.logfile,
+                fmt = args.logformat,
+                max_queue = args.logqueue,
+                policy = args.logpolicy,
+                max_bytes = args.logmaxsize * 1024 * 1024,
+                backups = args.logbackups,
+        )
+    except Exception as e:
+        print(f"Error opening log file: {e}")
+        exit(1)
+
+    # first, so that blocking during startup is reported too
+    watchdog = DNSTWatchdog.configure(threshold = args.stallthreshold)
+    if watchdog.enabled:
+        watchdog.start()
+
+    edns.configure(args.ednssize)
+    DNSTAdmission.configure(
+            max_inflight = args.maxinflight,
+            max_queue = args.maxqueue,
+            queue_timeout = args.queuetimeout,
+            policy = args.shed,
+    )
+
+    heavy_hitters = DNSTHeavyHitters.configure(capacity = args.topsize, half_life = args.tophalflife)
+
+    if args.shmcache != None:
         try:
-            f = open(args.logfile, "a")
-            sys.stdout = f
-            sys.stderr = f
-        except Exception as e:
-            await log(f"Error opening or writing to file: {e}")
-            exit(1)
+            DNSTCache.get_instance().configure_shared(args.shmcache, args.shmslots)
+        except (OSError, ValueError) as e:
+            await log(f"Error opening shared cache in {args.shmcache}: {e}")
+            logger.close()
+            return
+
+    if args.querylog != None:
+        DNSTQueryLog.configure(target = args.querylog)
 
     nft = None
     try:
@@ -110,33 +240,40 @@ async def main():
         await log(f"Warning: failed to initialize nftables: {e}")
 
     await log("Starting DNSTables server...")
-    if args.rulefile != None:
-        with open(args.rulefile, "r") as f:
-            for line  in f:
-                line = line.strip() # remove leading spaces
-                if not line or line.startswith("#"): # skip comments
-                    continue
-                err = cmd(line)
-                if err != None:
-                    print(f"error while parsing rulefile {args.rulefile}: {err}")
-                    return
+    if args.snapshot != None:
+        err = load_snapshot(args.snapshot)
+        if err != None:
+            await log(err)
+            logger.close()
+            return
+        await log(f"Loaded snapshot {args.snapshot}")
+    elif args.rulefile != None:
+        for line in iter_rulefile(args.rulefile):
+            err = cmd(line)
+            if err != None:
+                await log(f"error while parsing rulefile {args.rulefile}: {err}")
+                logger.close()
+                return
     else:
         await log("No rulefile specified.")
 
     # background cache cleanup task scheduled about every second
     #asyncio.create_task(DNSTCache.get_instance().cleanup_cache_periodically(period=1))
     asyncio.ensure_future(DNSTCache.get_instance().cleanup_cache_periodically(period=1))
+    if heavy_hitters.enabled:
+        asyncio.ensure_future(heavy_hitters.decay_periodically(period=1))
 
     loop = asyncio.get_event_loop()
     transport, protocol = await loop.create_datagram_endpoint(
         lambda: DNSDatagramProtocol(),
-        local_addr=(args.listen, args.port)
+        local_addr=(args.listen, args.port),
+        reuse_port=args.reuseport,
     )
 
     # daemon to adjust nftables
-    if os.path.exists(CMD_SOCKET_PATH):
-        os.remove(CMD_SOCKET_PATH)
-    daemon = await asyncio.start_unix_server(handle_cmd, path=CMD_SOCKET_PATH)
+    if os.path.exists(args.cmdsocket):
+        os.remove(args.cmdsocket)
+    daemon = await asyncio.start_unix_server(handle_cmd, path=args.cmdsocket)
 
     # Shutdown handler
     stop_event = asyncio.Event()
@@ -149,18 +286,24 @@ async def main():
             sig,
             lambda s=sig: asyncio.create_task(handle_shutdown(s))
         )
+
+    # reload the rulefile, only applying what changed
+    async def handle_reload():
+        await log(await reload(args.rulefile))
+    loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.create_task(handle_reload()))
     async with daemon:
         await stop_event.wait()
 
     # cleanup
     await log("Daemon stopped")
     transport.close()
-    if os.path.exists(CMD_SOCKET_PATH):
-        os.remove(CMD_SOCKET_PATH)
-    if f != None:
-        f.close()
+    if os.path.exists(args.cmdsocket):
+        os.remove(args.cmdsocket)
     if nft != None:
         nft.flush()
+    if DNSTQueryLog.get_instance() != None:
+        DNSTQueryLog.get_instance().close()
+    logger.close()
 
 
 def valid_ip(value):
@@ -184,7 +327,26 @@ def parse_args():
     parser.add_argument("--port", type=valid_port, help="Listen port for DNS queries", default=53)
     parser.add_argument("--verbose", type=str, help="Default verbose level for query tracer", choices=["none", "err", "warn", "info", "debug"], default="warn")
     parser.add_argument("--rulefile", type=str, default=None)
+    parser.add_argument("--snapshot", type=str, help="Start from a snapshot made by 'dnst.py compile' instead of the rulefile, which is still used by reload", default=None)
     parser.add_argument("--logfile", type=str, default=None)
+    parser.add_argument("--logformat", type=str, help="Log file format", choices=DNSTLogger.formats, default="text")
+    parser.add_argument("--logmaxsize", type=int, help="Rotate the log file beyond this size in MB, 0 to never rotate", default=0)
+    parser.add_argument("--logbackups", type=int, help="Number of rotated log files to keep", default=3)
+    parser.add_argument("--logqueue", type=int, help="Max number of log records waiting to be written", default=65536)
+    parser.add_argument("--logpolicy", type=str, help="What to drop when logging can't keep up", choices=DNSTLogger.policies, default="drop")
+    parser.add_argument("--querylog", type=str, help="Write a binary record of every query to FILE, or to unix:PATH", default=None)
+    parser.add_argument("--stallthreshold", type=float, help="Log the stack of callbacks blocking the event loop for longer than this many seconds, 0 to disable", default=0.1)
+    parser.add_argument("--topsize", type=int, help="Names and clients tracked by each 'dnst.py top' sketch, 0 to disable", default=1024)
+    parser.add_argument("--tophalflife", type=float, help="Seconds after which 'dnst.py top' weights are halved", default=60)
+    parser.add_argument("--shmcache", type=str, help="Share the cache with other processes through memory mapped files in this directory", default=None)
+    parser.add_argument("--shmslots", type=int, help="Entries of each shared cache view, unless set with 'cache size'", default=65536)
+    parser.add_argument("--reuseport", action="store_true", help="Let several processes listen on the same address and port")
+    parser.add_argument("--cmdsocket", type=str, help="Control socket path", default=CMD_SOCKET_PATH)
+    parser.add_argument("--maxinflight", type=int, help="Max queries handled at once, 0 for no limit", default=4096)
+    parser.add_argument("--maxqueue", type=int, help="Max queries waiting beyond --maxinflight", default=4096)
+    parser.add_argument("--queuetimeout", type=float, help="Shed queries that waited longer than this many seconds", default=1.0)
+    parser.add_argument("--shed", type=str, help="How to shed queries when overloaded", choices=DNSTAdmission.policies, default="refused")
+    parser.add_argument("--ednssize", type=int, help="EDNS0 UDP payload size advertised to clients and upstreams", default=1232)
     return parser.parse_args()
 
 
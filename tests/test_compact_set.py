@@ -0,0 +1,86 @@
+import os
+import sys
+import types
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# libnftables is only needed to talk to the kernel, the rules below never do
+if "nftables" not in sys.modules:
+    sys.modules["nftables"] = types.SimpleNamespace(Nftables = object)
+
+from dnst_core import DNSTables
+from dnst_engine import cmd
+from matchers import QnameMatcher
+from utils import compact_set
+from utils.compact_set import CompactSet
+
+
+class TestCompactSet(unittest.TestCase):
+    def setUp(self):
+        DNSTables._instance = None
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+        DNSTables._instance = None
+
+    def write_file(self, name, lines):
+        path = os.path.join(self.dir.name, name)
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return path
+
+    def test_repeated_file_loads(self):
+        first = self.write_file("first", [f"a{i}.example" for i in range(1000)])
+        second = self.write_file("second", [f"b{i}.example" for i in range(1000)] + ["a1.example"])
+        third = self.write_file("third", [f"a{i}.example" for i in range(500)])
+        self.assertEqual(cmd("add set ads compact bloom"), None)
+        self.assertEqual(cmd(f"add element ads file {first}"), None)
+        self.assertEqual(cmd(f"add element ads file {second}"), None)
+        ads = DNSTables.get_instance().sets["ads"]
+        self.assertEqual(len(ads), 2000)
+        self.assertEqual(cmd(f"delete element ads file {third}"), None)
+        ads = DNSTables.get_instance().sets["ads"]
+        self.assertEqual(len(ads), 1500)
+        self.assertNotIn("a1.example", ads)
+        self.assertIn("a500.example", ads)
+        self.assertIn("b999.example", ads)
+
+    def test_bulk_merge_after_single_changes(self):
+        ads = CompactSet(iter([f"a{i}.example" for i in range(100)]), bloom = True)
+        ads.add("new.example")
+        ads.discard("a1.example")
+        ads.discard("missing.example")
+        self.assertEqual(ads.stats()["pending"], 2)
+        # more than BULK elements, merged into a new blob along with the pending changes
+        ads.update([f"b{i}.example" for i in range(compact_set.BULK + 1)])
+        self.assertEqual(ads.stats()["pending"], 0)
+        self.assertEqual(len(ads), 100 + compact_set.BULK + 1)
+        self.assertIn("new.example", ads)
+        self.assertNotIn("a1.example", ads)
+        self.assertIn("a2.example", ads)
+        self.assertEqual(sorted(ads), sorted(set(ads)))
+
+        # and a second bulk merge, with the blob of the first one
+        ads.discard("a2.example")
+        ads.update(iter(["c.example", "new.example"]))
+        self.assertEqual(len(ads), 100 + compact_set.BULK + 1)
+        self.assertNotIn("a2.example", ads)
+        self.assertIn("c.example", ads)
+
+    def test_qname_wildcards(self):
+        path = self.write_file("hosts", ["0.0.0.0 ads.example", "0.0.0.0 *.tracker.example", "0.0.0.0 *.bad.example"])
+        self.assertEqual(cmd("add set ads compact"), None)
+        self.assertEqual(cmd(f"add element ads file {path} format hosts"), None)
+        self.assertEqual(cmd(f"add element ads file {path} format hosts"), None)
+        matcher = QnameMatcher(qname_matcher = "@ads")
+        for qname, matched in [("ads.example", True), ("www.ads.example", False),
+                               ("tracker.example", False), ("a.tracker.example", True),
+                               ("a.b.tracker.example", True), ("www.bad.example", True), ("bad.example", False)]:
+            self.assertEqual(matcher._match(None, qname), matched, qname)
+
+
+if __name__ == "__main__":
+    unittest.main()
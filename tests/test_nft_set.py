@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# libnftables is only needed to talk to the kernel, json_cmd is replaced by a stub below
+if "nftables" not in sys.modules:
+    sys.modules["nftables"] = types.SimpleNamespace(Nftables = object)
+
+from utils import nft_set
+from utils.ipv4 import ip_to_int
+
+
+# records every json_cmd call, and rejects any transaction that touches the "missing" table
+class StubNftables:
+    calls = []
+
+    def json_cmd(self, cmd):
+        StubNftables.calls.append(cmd)
+        tables = [entry["add"]["element"]["table"] for entry in cmd["nftables"]]
+        if "missing" in tables:
+            return 1, "", "Error: No such file or directory\n"
+        return 0, "", ""
+
+
+def elements(cmd):
+    return {(entry["add"]["element"]["table"], entry["add"]["element"]["name"]):
+            {elem["elem"]["val"]: elem["elem"]["timeout"] for elem in entry["add"]["element"]["elem"]}
+            for entry in cmd["nftables"]}
+
+
+class TestNftSets(unittest.TestCase):
+    def setUp(self):
+        StubNftables.calls = []
+        self.nft = nft_set.Nftables
+        nft_set.Nftables = StubNftables
+        self.sets = nft_set.DNSTNftSets(flush_interval = 0.1)
+
+    def tearDown(self):
+        nft_set.Nftables = self.nft
+
+    def wait_calls(self, count):
+        deadline = time.monotonic() + 2
+        while len(StubNftables.calls) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        self.assertEqual(len(StubNftables.calls), count)
+
+    def test_one_transaction_per_flush(self):
+        self.sets.add(("inet", "filter", "a"), [(ip_to_int("192.0.2.1"), 60), (ip_to_int("192.0.2.2"), 30)])
+        self.sets.add(("ip", "filter", "b"), [(ip_to_int("192.0.2.3"), 0)])
+        self.wait_calls(1)
+        self.assertEqual(elements(StubNftables.calls[0]), {
+            ("filter", "a"): {"192.0.2.1": 60, "192.0.2.2": 30},
+            ("filter", "b"): {"192.0.2.3": 1},
+        })
+        self.assertEqual(self.sets.batches, 1)
+        self.assertEqual(self.sets.added, 3)
+
+    def test_repeated_elements(self):
+        target = ("inet", "filter", "a")
+        ip = ip_to_int("192.0.2.1")
+        self.sets.add(target, [(ip, 60), (ip, 60)])
+        self.assertEqual((self.sets.queued, self.sets.deduped), (1, 1))
+        # less than half of the new ttl left: queued again, and merged with the first one in the batch
+        self.sets.present[target][ip] = time.monotonic() + 10
+        self.sets.add(target, [(ip, 120)])
+        self.assertEqual((self.sets.queued, self.sets.deduped), (2, 1))
+        self.wait_calls(1)
+        self.assertEqual(elements(StubNftables.calls[0]), {("filter", "a"): {"192.0.2.1": 120}})
+        self.assertEqual(self.sets.added, 1)
+
+    def test_rejected_set(self):
+        self.sets.add(("inet", "filter", "a"), [(ip_to_int("192.0.2.1"), 60)])
+        self.sets.add(("inet", "missing", "b"), [(ip_to_int("192.0.2.2"), 60)])
+        # the batch fails as a whole, then each set is written alone
+        self.wait_calls(3)
+        self.assertEqual([list(elements(cmd)) for cmd in StubNftables.calls[1:]],
+                         [[("filter", "a")], [("missing", "b")]])
+        self.assertEqual((self.sets.added, self.sets.errors), (1, 1))
+
+    def test_missing_set(self):
+        self.sets.add(("inet", "missing", "b"), [(ip_to_int("192.0.2.2"), 60)])
+        self.wait_calls(1)
+        self.assertEqual((self.sets.added, self.sets.errors), (0, 1))
+        # the worker keeps going, and the ip that failed is queued again instead of deduped
+        self.sets.add(("inet", "filter", "a"), [(ip_to_int("192.0.2.1"), 60)])
+        self.sets.add(("inet", "missing", "b"), [(ip_to_int("192.0.2.2"), 60)])
+        self.assertEqual((self.sets.queued, self.sets.deduped), (3, 0))
+        self.wait_calls(4)
+        self.assertEqual((self.sets.added, self.sets.errors), (1, 2))
+        # only the ip written before is deduped
+        self.sets.add(("inet", "filter", "a"), [(ip_to_int("192.0.2.1"), 60)])
+        self.assertEqual(self.sets.deduped, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+import time
+import struct
+from collections import deque
+
+header_struct = struct.Struct("!HHHHHH")
+RCODE_SERVFAIL = 2
+RCODE_REFUSED = 5
+
+
+# (qname, qtype, end of question) of a single question query, parsed straight from the wire
+# None for anything else, compression pointers can't appear in the first question
+def parse_question(data):
+    if len(data) < header_struct.size or header_struct.unpack_from(data)[2] != 1:
+        return None
+    labels = []
+    offset = header_struct.size
+    while offset < len(data):
+        length = data[offset]
+        offset += 1
+        if length == 0:
+            if offset + 4 > len(data):
+                return None
+            qtype = (data[offset] << 8) | data[offset + 1]
+            return ".".join(labels), qtype, offset + 4
+        if length & 0xc0:
+            return None
+        labels.append(data[offset:offset + length].decode("ascii", "replace"))
+        offset += length
+    return None
+
+
+# reply with rcode and the question only, without a full parse so that shedding stays cheap
+def error_reply(data, rcode):
+    question = parse_question(data)
+    if question == None:
+        return None
+    query_id, flags = struct.unpack_from("!HH", data)
+    # QR, keep opcode and RD, RA, rcode
+    flags = 0x8000 | (flags & 0x7900) | 0x0080 | rcode
+    return struct.pack("!HHHHHH", query_id, flags, 1, 0, 0, 0) + data[header_struct.size:question[2]]
+
+
+# bounds the number of queries being handled at once
+# queries beyond max_inflight wait in a bounded queue, queries that can be answered from cache first
+# queries are shed when the queue is full, or when they waited longer than a client would
+class DNSTAdmission:
+    _instance = None
+    policies = ["refused", "servfail", "drop"]
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance == None:
+            cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def configure(cls, **kwargs):
+        cls._instance = cls(**kwargs)
+        return cls._instance
+
+    # max_inflight: 0 for no limit
+    def __init__(self, max_inflight = 0, max_queue = 4096, queue_timeout = 1.0, policy = "refused"):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.policy = policy
+        self.inflight = 0
+        self.cached_queue = deque() # (enqueue time, item)
+        self.queue = deque()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.peak_inflight = self.inflight
+        self.admitted = 0
+        self.queued = 0
+        self.shed_full = 0
+        self.shed_expired = 0
+
+    # returns (verdict, item to shed or None), verdict is "run" if the caller must handle item now, "queued", or "shed"
+    # a query answerable from cache takes the place of the latest queued query that is not when the queue is full
+    # is_cached is only called when the query has to wait
+    def submit(self, item, is_cached):
+        if self.max_inflight == 0 or self.inflight < self.max_inflight:
+            self._start()
+            return "run", None
+        cached = is_cached()
+        displaced = None
+        if len(self.cached_queue) + len(self.queue) >= self.max_queue:
+            if not cached or len(self.queue) == 0:
+                self.shed_full += 1
+                return "shed", None
+            displaced = self.queue.pop()[1]
+            self.shed_full += 1
+        self.queued += 1
+        (self.cached_queue if cached else self.queue).append((time.monotonic(), item))
+        return "queued", displaced
+
+    def _start(self):
+        self.admitted += 1
+        self.inflight += 1
+        if self.inflight > self.peak_inflight:
+            self.peak_inflight = self.inflight
+
+    # a query is done, returns (item to run next or None, items to shed)
+    def done(self):
+        self.inflight -= 1
+        expired = self.expire()
+        for queue in [self.cached_queue, self.queue]:
+            if len(queue) > 0:
+                self._start()
+                return queue.popleft()[1], expired
+        return None, expired
+
+    # queued items that waited longer than queue_timeout, to shed
+    def expire(self):
+        expired = []
+        deadline = time.monotonic() - self.queue_timeout
+        for queue in [self.cached_queue, self.queue]:
+            while len(queue) > 0 and queue[0][0] < deadline:
+                self.shed_expired += 1
+                expired.append(queue.popleft()[1])
+        return expired
+
+    # seconds until the oldest queued item expires, None when nothing is queued
+    # queries are still shed in time when every query in flight waits on a slow upstream
+    def next_expiry(self):
+        oldest = min([queue[0][0] for queue in [self.cached_queue, self.queue] if len(queue) > 0], default = None)
+        if oldest == None:
+            return None
+        return max(0.0, oldest + self.queue_timeout - time.monotonic())
+
+    def shed_reply(self, data):
+        if self.policy == "drop":
+            return None
+        return error_reply(data, RCODE_REFUSED if self.policy == "refused" else RCODE_SERVFAIL)
+
+    def stats(self):
+        return {
+            "inflight": self.inflight,
+            "peak_inflight": self.peak_inflight,
+            "max_inflight": self.max_inflight,
+            "queued_now": len(self.cached_queue) + len(self.queue),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "shed_queue_full": self.shed_full,
+            "shed_expired": self.shed_expired,
+        }
@@ -1,10 +1,92 @@
 import time
 import heapq
 import asyncio
-from sortedcontainers import SortedDict
+from collections import OrderedDict
+from utils.shm_cache import SharedCacheView
+
+# an independent partition of the cache, e.g. for clients that get different answers for the same names
+class CacheView:
+    def __init__(self, name, max_entries = None):
+        self.name = name
+        self.max_entries = max_entries # None for no limit
+        # (qname, qtype), (answer, fake_net_pool), answer is a tuple of (ip as int, expiry_time)
+        # LRU ordered, the least recently used entry is evicted when the view is full
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _release(self, qname, entry):
+        answer, pool = entry
+        if pool != None:
+            pool.unregister(qname)
+
+    def resize(self, max_entries):
+        self.max_entries = max_entries
+        while max_entries != None and len(self.entries) > max_entries:
+            (qname, _), entry = self.entries.popitem(last = False)
+            self._release(qname, entry)
+            self.evictions += 1
+
+    # answer: tuple of (ip, expiry_time)
+    # returns when the earliest answer expires, for DNSTCache to schedule the cleanup
+    def put(self, qname, qtype, answer, pool):
+        key = (qname, qtype)
+        if key not in self.entries and self.max_entries != None and len(self.entries) >= self.max_entries:
+            (evicted_qname, _), entry = self.entries.popitem(last = False)
+            self._release(evicted_qname, entry)
+            self.evictions += 1
+        self.entries[key] = (answer, pool)
+        self.entries.move_to_end(key)
+        return min(expiry_time for _, expiry_time in answer)
+
+    def get(self, qname, qtype, now):
+        entry = self.entries.get((qname, qtype))
+        if entry != None:
+            answer = [(ip, int(expiry_time - now)) for ip, expiry_time in entry[0] if expiry_time > now]
+            if len(answer) > 0:
+                self.hits += 1
+                self.entries.move_to_end((qname, qtype))
+                return answer
+        self.misses += 1
+        return None
+
+    def contains(self, qname, qtype, now):
+        entry = self.entries.get((qname, qtype))
+        return entry != None and any(expiry_time > now for _, expiry_time in entry[0])
+
+    # drop expired answers, returns when the next remaining answer expires, if any
+    def expire(self, qname, qtype, now):
+        if (qname, qtype) not in self.entries:
+            return None
+        answer, pool = self.entries[(qname, qtype)]
+        alive = tuple(entry for entry in answer if entry[1] > now)
+        if len(alive) == len(answer):
+            return None # replaced by a fresher answer since
+        # unregister from pool if is fake ip
+        if pool != None:
+            pool.unregister(qname)
+        if len(alive) == 0:
+            del self.entries[(qname, qtype)]
+            return None
+        self.entries[(qname, qtype)] = (alive, pool)
+        return min(expiry_time for _, expiry_time in alive)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups > 0 else None,
+        }
+
 
 class DNSTCache:
     _instance = None
+    default_view = "default"
 
     @classmethod
     def get_instance(cls):
@@ -13,39 +95,66 @@ class DNSTCache:
         return cls._instance
 
     def __init__(self):
-        self.dns_cache = dict()
+        self.views = {self.default_view: CacheView(self.default_view)}
         self.current_time = time.monotonic()
-        self.expiry_heap = []
+        self.expiry_heap = [] # (expiry_time, view, qname, qtype)
+        self.shared_dir = None
+        self.shared_slots = None
+
+    # store views in shared memory files under directory, shared with other processes using the same directory
+    # views that already exist keep their entries in process memory
+    def configure_shared(self, directory, slots):
+        self.shared_dir = directory
+        self.shared_slots = slots
+        if len(self.views[self.default_view].entries) == 0:
+            del self.views[self.default_view]
+            self.view(self.default_view)
+
+    def view(self, name = None, max_entries = None):
+        name = name or self.default_view
+        if name not in self.views and self.shared_dir != None:
+            self.views[name] = SharedCacheView(name, f"{self.shared_dir}/{name}.cache", max_entries or self.shared_slots)
+        elif name not in self.views:
+            self.views[name] = CacheView(name, max_entries)
+        elif max_entries != None and self.views[name].max_entries != max_entries:
+            self.views[name].resize(max_entries)
+        return self.views[name]
 
     # These methods are atomic accross coroutines in dict/list operations
     # so no need for locking
-    def cache(self, qname, qtype, answer, fake_net_pool = None, **kwargs):
-        if (qname, qtype) not in self.dns_cache:
-            self.dns_cache[(qname, qtype)] = []
-        cache_list = self.dns_cache[(qname, qtype)]
-
-        for ip, ttl in answer:
-            expiry_time = self.current_time + ttl
-            cache_entry = {
-                "ip": ip,
-                "expiry_time": expiry_time
-            }
-            if fake_net_pool != None:
-                cache_entry['pool'] = fake_net_pool
-
-            self.dns_cache[(qname, qtype)].append(cache_entry)
-            heapq.heappush(self.expiry_heap, (expiry_time, qname, qtype))
-
-    def get_cache(self, qname, qtype, **kwargs):
-        if (qname, qtype) in self.dns_cache:
-            cache_list = self.dns_cache[(qname, qtype)]
-            if len(cache_list) > 0:
-                return [
-                    [entry["ip"], int(entry["expiry_time"] - self.current_time)]
-                    for entry in cache_list
-                    if entry["expiry_time"] > self.current_time
-                ]
-        return None
+    def cache(self, qname, qtype, answer, fake_net_pool = None, view = None, max_entries = None, **kwargs):
+        cache_view = self.view(view, max_entries)
+        answer = tuple((ip, self.current_time + ttl) for ip, ttl in answer)
+        expiry_time = cache_view.put(qname, qtype, answer, fake_net_pool)
+        if expiry_time != None:
+            heapq.heappush(self.expiry_heap, (expiry_time, cache_view.name, qname, qtype))
+
+    def get_cache(self, qname, qtype, view = None, **kwargs):
+        cache_view = self.views.get(view or self.default_view)
+        if cache_view == None:
+            return None
+        return cache_view.get(qname, qtype, self.current_time)
+
+    # whether any view could answer, without counting a lookup
+    def contains(self, qname, qtype):
+        return any(view.contains(qname, qtype, self.current_time) for view in self.views.values())
+
+    def stats(self):
+        hits = sum(view.hits for view in self.views.values())
+        misses = sum(view.misses for view in self.views.values())
+        return {
+            "entries": sum(view.stats()["entries"] for view in self.views.values()),
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / (hits + misses) if hits + misses > 0 else None,
+            "views": {name: view.stats() for name, view in self.views.items()},
+        }
+
+    def reset_stats(self):
+        for view in self.views.values():
+            view.hits = 0
+            view.misses = 0
+            view.evictions = 0
 
     async def cleanup_cache_periodically(self, period):
         while True:
@@ -54,15 +163,12 @@ class DNSTCache:
 
             # cleanup expired cache entries using the heap
             while self.expiry_heap and self.expiry_heap[0][0] <= self.current_time:
-                _, qname, qtype = heapq.heappop(self.expiry_heap)
-                if (qname, qtype) not in self.dns_cache:
+                _, view, qname, qtype = heapq.heappop(self.expiry_heap)
+                cache_view = self.views.get(view)
+                if cache_view == None:
                     continue
-                current_list = self.dns_cache[(qname, qtype)]
-                expired_list = [entry for entry in current_list if entry["expiry_time"] <= self.current_time]
-                for entry in expired_list:
-                    # unregister from pool if is fake ip
-                    if "pool" in entry:
-                        entry["pool"].unregister(qname)
-                self.dns_cache[(qname, qtype)] = [entry for entry in current_list if entry["expiry_time"] > self.current_time]
+                expiry_time = cache_view.expire(qname, qtype, self.current_time)
+                if expiry_time != None:
+                    heapq.heappush(self.expiry_heap, (expiry_time, view, qname, qtype))
 
             await asyncio.sleep(period)
@@ -0,0 +1,174 @@
+import zlib
+import heapq
+import bisect
+from array import array
+
+# memory compact set of strings, for blocklists of millions of domains
+# elements are kept sorted in one "\n" separated bytes blob, in blocks of BLOCK elements:
+# a lookup bisects the first element of each block, then searches the bytes of that block
+# elements added or deleted one by one since the blob was built are kept in two small python sets,
+# bulk updates (element files, big element lists) merge into a new blob instead
+BLOCK = 16
+RUN = 262144 # elements sorted at once during a bulk update, bounds the memory of the update
+BULK = 4096 # updates with more elements than this rebuild the blob
+BLOOM_BITS = 16 # bloom filter bits per element, about 1.4% false positives with 2 hashes
+
+
+# sorted elements of a "\n" separated blob, one at a time
+def _iter_blob(blob, start, end):
+    while start < end:
+        stop = blob.find(b"\n", start, end)
+        if stop < 0:
+            stop = end
+        yield bytes(blob[start:stop])
+        start = stop + 1
+
+
+def _unique(keys):
+    last = None
+    for key in keys:
+        if key != last:
+            yield key
+            last = key
+
+
+class CompactSet:
+    # bloom: keep a bloom filter in front of the blob, so that most lookups of absent elements stop there
+    def __init__(self, elements = (), bloom = False):
+        self.use_bloom = bloom
+        self.added = set()
+        self.removed = set() # elements of the blob that were deleted
+        self._build([])
+        self.update(elements)
+
+    def _build(self, keys):
+        blob = bytearray(b"\n")
+        starts = array("Q") # offset of the "\n" before the first element of each block, and of the last "\n"
+        firsts = [] # first element of each block
+        count = 0
+        for key in keys:
+            if count % BLOCK == 0:
+                starts.append(len(blob) - 1)
+                firsts.append(key)
+            blob += key
+            blob += b"\n"
+            count += 1
+        starts.append(len(blob) - 1)
+        self.blob = blob
+        self.starts = starts
+        self.firsts = firsts
+        self.count = count
+        self.bloom = None
+        if self.use_bloom:
+            self.bloom_size = max(64, count * BLOOM_BITS)
+            bloom = bytearray(self.bloom_size // 8 + 1)
+            for key in _iter_blob(blob, 1, len(blob)):
+                for h in self._hashes(key):
+                    bloom[h >> 3] |= 1 << (h & 7)
+            self.bloom = bloom
+
+    # two bit positions from one stable hash, the filter is part of snapshots so hash() can't be used
+    def _hashes(self, key):
+        h = zlib.crc32(key)
+        return h % self.bloom_size, (h * 2654435761 >> 16) % self.bloom_size
+
+    def _blob_contains(self, key):
+        bloom = self.bloom
+        if bloom != None:
+            h = zlib.crc32(key)
+            h0 = h % self.bloom_size
+            h1 = (h * 2654435761 >> 16) % self.bloom_size
+            if not bloom[h0 >> 3] & (1 << (h0 & 7)) or not bloom[h1 >> 3] & (1 << (h1 & 7)):
+                return False
+        i = bisect.bisect_right(self.firsts, key) - 1
+        return i >= 0 and self.blob.find(b"\n" + key + b"\n", self.starts[i], self.starts[i + 1] + 1) >= 0
+
+    def _blob_keys(self):
+        return _iter_blob(self.blob, 1, len(self.blob))
+
+    def __contains__(self, key):
+        if key in self.added:
+            return True
+        return key not in self.removed and self._blob_contains(key.encode())
+
+    def __len__(self):
+        return self.count - len(self.removed) + len(self.added)
+
+    def __iter__(self):
+        for key in self._blob_keys():
+            key = key.decode()
+            if key not in self.removed:
+                yield key
+        yield from self.added
+
+    # only equal to another CompactSet of the same kind, so that a reload replaces a set declared differently
+    def __eq__(self, other):
+        if not isinstance(other, CompactSet):
+            return NotImplemented
+        if self.use_bloom != other.use_bloom or len(self) != len(other):
+            return False
+        if len(self.added) + len(self.removed) + len(other.added) + len(other.removed) == 0:
+            return self.blob == other.blob
+        return all(key in other for key in self)
+
+    # the blob is never changed in place, a bulk update builds a new one, so copies share it
+    def copy(self):
+        other = CompactSet.__new__(CompactSet)
+        other.__dict__.update(self.__dict__)
+        other.added = set(self.added)
+        other.removed = set(self.removed)
+        return other
+
+    def add(self, key):
+        if key in self.removed:
+            self.removed.discard(key)
+        elif not self._blob_contains(key.encode()):
+            self.added.add(key)
+
+    def discard(self, key):
+        if key in self.added:
+            self.added.discard(key)
+        elif self._blob_contains(key.encode()):
+            self.removed.add(key)
+
+    # returns the number of keys consumed
+    def update(self, keys):
+        if isinstance(keys, (list, tuple, set, frozenset)) and len(keys) <= BULK:
+            for key in keys:
+                self.add(key)
+            return len(keys)
+
+        # sorted runs of the new keys, merged with the current elements into a new blob
+        runs = []
+        chunk = []
+        count = 0
+        for key in keys:
+            chunk.append(key.encode())
+            count += 1
+            if len(chunk) >= RUN:
+                runs.append(b"\n".join(sorted(set(chunk))))
+                chunk = []
+        if len(chunk) > 0:
+            runs.append(b"\n".join(sorted(set(chunk))))
+        del chunk
+        if len(runs) == 0:
+            return count
+
+        removed = {key.encode() for key in self.removed}
+        current = (key for key in self._blob_keys() if key not in removed)
+        added = sorted(key.encode() for key in self.added)
+        merged = heapq.merge(current, added, *[_iter_blob(run, 0, len(run)) for run in runs])
+        self._build(_unique(merged))
+        self.added = set()
+        self.removed = set()
+        return count
+
+    def stats(self):
+        return {
+            "elements": len(self),
+            "compact": True,
+            "bloom": self.use_bloom,
+            "bytes": len(self.blob) + self.starts.itemsize * len(self.starts)
+                     + sum(len(key) + 33 for key in self.firsts) + (len(self.bloom) if self.bloom != None else 0),
+            "pending": len(self.added) + len(self.removed),
+        }
@@ -0,0 +1,77 @@
+import struct
+import asyncio
+from dnslib import DNSRecord, EDNS0, QTYPE
+
+# plain DNS over UDP is limited to 512 bytes, EDNS0 (RFC 6891) lets both sides advertise more
+DEFAULT_UDP_SIZE = 512
+# advertised to clients and upstreams, 1232 avoids IP fragmentation on most paths
+udp_size = 1232
+# buffer used to receive upstream replies, whatever they advertise
+MAX_UDP_SIZE = 65535
+
+header_struct = struct.Struct("!HHHHHH")
+opt_struct = struct.Struct("!BHHIH") # root name, type, udp size, ext rcode/version/flags, rdlen
+
+
+def configure(size):
+    global udp_size
+    udp_size = max(DEFAULT_UDP_SIZE, size)
+
+
+def get_opt(record):
+    for rr in record.ar:
+        if rr.rtype == QTYPE.OPT:
+            return rr
+    return None
+
+
+# largest reply sent to the client over UDP, never more than we advertise
+def client_udp_size(request):
+    opt = get_opt(request)
+    if opt == None:
+        return DEFAULT_UDP_SIZE
+    return min(max(DEFAULT_UDP_SIZE, opt.rclass), udp_size)
+
+
+# only answer with an OPT record to clients that sent one
+# if the packed reply does not fit, send it without answers and with TC set so the client retries over TCP
+def pack_reply(request, reply):
+    if get_opt(request) != None:
+        reply.add_ar(EDNS0(udp_len = udp_size))
+    data = reply.pack()
+    if len(data) > client_udp_size(request):
+        reply.header.tc = 1
+        reply.rr = []
+        data = reply.pack()
+    return data
+
+
+# make sure the query sent upstream advertises our udp size
+# most queries have no additional record, so the OPT record is appended without a full parse
+def upstream_query(raw_query):
+    header = header_struct.unpack_from(raw_query)
+    arcount = header[5]
+    if arcount == 0:
+        return (header_struct.pack(*header[:5], 1) + raw_query[header_struct.size:]
+                + opt_struct.pack(0, QTYPE.OPT, udp_size, 0, 0))
+    request = DNSRecord.parse(raw_query)
+    opt = get_opt(request)
+    if opt == None:
+        request.add_ar(EDNS0(udp_len = udp_size))
+    else:
+        opt.rclass = udp_size
+    return request.pack()
+
+
+# used when an upstream reply over UDP was truncated
+async def query_tcp(data, ip, port, timeout):
+    async def exchange():
+        reader, writer = await asyncio.open_connection(ip, port)
+        try:
+            writer.write(struct.pack("!H", len(data)) + data)
+            await writer.drain()
+            length = struct.unpack("!H", await reader.readexactly(2))[0]
+            return await reader.readexactly(length)
+        finally:
+            writer.close()
+    return await asyncio.wait_for(exchange(), timeout = timeout)
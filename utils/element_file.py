@@ -0,0 +1,90 @@
+import csv
+import os
+from utils.compact_set import CompactSet
+
+formats = ["plain", "hosts", "csv"]
+
+# generators below stream the file line by line and never build a list of elements
+# sets get keys, maps get (key, value) tuples
+
+def _iter_plain(f, is_map):
+    for line in f:
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        parts = line.split()
+        if not is_map:
+            yield parts[0]
+        elif len(parts) >= 2: # "key value" or "key : value"
+            yield (parts[0], parts[-1])
+
+
+def _iter_hosts(f, is_map):
+    for line in f:
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        ip, *hostnames = parts
+        for hostname in hostnames:
+            if is_map:
+                yield (hostname.lower(), ip)
+            else:
+                yield hostname.lower()
+
+
+def _iter_csv(f, is_map):
+    for row in csv.reader(f):
+        if len(row) == 0 or row[0].startswith("#"):
+            continue
+        if not is_map:
+            yield row[0].strip()
+        elif len(row) >= 2:
+            yield (row[0].strip(), row[1].strip())
+
+
+format_to_iter = {
+    "plain": _iter_plain,
+    "hosts": _iter_hosts,
+    "csv":   _iter_csv,
+}
+
+def iter_elements(path, fmt, is_map):
+    with open(path, "r", newline = "", errors = "replace") as f:
+        yield from format_to_iter[fmt](f, is_map)
+
+
+# load elements from file into target (a set or a dict), return the number of lines consumed
+def load_elements(target, path, fmt, is_add = True):
+    is_map = isinstance(target, dict)
+    count = 0
+    if is_add and is_map:
+        for key, value in iter_elements(path, fmt, is_map):
+            target[key] = value
+            count += 1
+    elif is_add and isinstance(target, CompactSet):
+        count = target.update(iter_elements(path, fmt, is_map))
+    elif is_add:
+        for key in iter_elements(path, fmt, is_map):
+            target.add(key)
+            count += 1
+    elif is_map:
+        for key, _ in iter_elements(path, fmt, is_map):
+            target.pop(key, None)
+            count += 1
+    else:
+        for key in iter_elements(path, fmt, is_map):
+            target.discard(key)
+            count += 1
+    return count
+
+
+# cheap change detection for the background watcher
+def file_signature(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+    except OSError:
+        return None
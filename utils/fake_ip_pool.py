@@ -1,7 +1,9 @@
 import ipaddress
 import time
 from utils.nft_wrapper import NftWrapper
+from utils.ipv4 import int_to_ip
 
+# ips are ints, as in answers, and only converted for nftables
 class FakeIP:
     def __init__(self, fake_ip, real_ip = None, domains = set()):
         self.fake_ip = fake_ip
@@ -16,15 +18,20 @@ class FakeIP:
 
 
 class FakeIPPool:
-    nft = NftWrapper.get_instance()
-
     def __init__(self, net):
+        # nftables is only set up once a pool is used, importing the actions must not touch it
+        self.nft = NftWrapper.get_instance()
         self.network = ipaddress.IPv4Network(net)
-        self.gen_pool = (str(ip) for ip in self.network.hosts()
+        self.gen_pool = (int(ip) for ip in self.network.hosts()
                      if ip.packed[-1] not in (0, 255))
         self.recycled_pool = []
         self.domain_to_fake_ip = {}
         self.real_to_fake_ip = {}
+        # number of usable fake ips, i.e., hosts not ending with .0 or .255
+        if self.network.prefixlen <= 24:
+            self.size = self.network.num_addresses // 256 * 254
+        else:
+            self.size = sum(1 for ip in self.network.hosts() if ip.packed[-1] not in (0, 255))
 
     # take a domain -> real_ip mapping and return the associated fake ip
     def _register(self, domain, real_ip):
@@ -57,9 +64,17 @@ class FakeIPPool:
         fip = FakeIP(fake_ip, real_ip = real_ip, domains = {domain})
         self.domain_to_fake_ip[domain] = fip
         self.real_to_fake_ip[real_ip] = fip
-        self.nft.add(fake_ip, real_ip)
+        self.nft.add(int_to_ip(fake_ip), int_to_ip(real_ip))
         return fip
 
+    def stats(self):
+        return {
+            "size": self.size,
+            "used": len(self.real_to_fake_ip),
+            "domains": len(self.domain_to_fake_ip),
+            "utilization": len(self.real_to_fake_ip) / self.size if self.size > 0 else None,
+        }
+
     def register(self, domain, real_ip):
         fip = self._register(domain, real_ip)
         if fip == None:
@@ -76,5 +91,5 @@ class FakeIPPool:
         fip.domains.remove(domain)
         if fip.is_free():
             self.real_to_fake_ip.pop(fip.real_ip)
-            self.nft.delete(fip.fake_ip)
+            self.nft.delete(int_to_ip(fip.fake_ip))
             self.recycled_pool.append(fip.fake_ip)
@@ -0,0 +1,99 @@
+import asyncio
+import heapq
+
+# space-saving sketch: the heaviest keys of a stream, in bounded memory
+# up to 2 * capacity keys are counted, beyond that only the capacity heaviest are kept
+# a key seen again after being dropped starts from `floor`, the heaviest weight dropped so far,
+# so weights are overestimated by at most the `error` recorded when the key came in
+class SpaceSaving:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = dict() # key, [weight, error]
+        self.floor = 0
+        self.total = 0
+
+    def add(self, key, weight = 1):
+        self.total += weight
+        try:
+            self.entries[key][0] += weight
+            return
+        except KeyError:
+            pass
+        if len(self.entries) >= 2 * self.capacity:
+            self._prune()
+        self.entries[key] = [self.floor + weight, self.floor]
+
+    # keeps the keys heavier than the capacity-th heaviest, fewer on ties
+    def _prune(self):
+        weights = sorted([entry[0] for entry in self.entries.values()], reverse = True)
+        cut = weights[self.capacity - 1]
+        self.entries = {key: entry for key, entry in self.entries.items() if entry[0] > cut}
+        self.floor = max(self.floor, cut)
+
+    def decay(self, factor):
+        for entry in self.entries.values():
+            entry[0] *= factor
+            entry[1] *= factor
+        self.floor *= factor
+        self.total *= factor
+
+    # [(key, weight, error)], heaviest first
+    def top(self, count):
+        ranked = heapq.nlargest(count, self.entries.items(), key = lambda item: item[1][0])
+        return [(key, weight, error) for key, (weight, error) in ranked]
+
+
+# top qnames, clients, nxdomain qnames, and qnames by time spent waiting for upstreams
+# weights decay exponentially, so that the top shows what is heavy now and not since startup
+class DNSTHeavyHitters:
+    _instance = None
+    kinds = ["qnames", "clients", "nxdomain", "latency"]
+    units = {"qnames": "queries", "clients": "queries", "nxdomain": "queries", "latency": "upstream seconds"}
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance == None:
+            cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def configure(cls, **kwargs):
+        cls._instance = cls(**kwargs)
+        return cls._instance
+
+    # capacity: 0 to disable
+    def __init__(self, capacity = 1024, half_life = 60):
+        self.capacity = capacity
+        self.half_life = half_life
+        self.enabled = capacity > 0
+        self.reset()
+
+    def reset(self):
+        self.sketches = {kind: SpaceSaving(self.capacity) for kind in self.kinds}
+
+    def observe(self, src, qname, verdict):
+        if not self.enabled:
+            return
+        self.sketches["qnames"].add(qname)
+        self.sketches["clients"].add(src)
+        if verdict == "nxdomain":
+            self.sketches["nxdomain"].add(qname)
+
+    def observe_upstream(self, qname, seconds):
+        if self.enabled:
+            self.sketches["latency"].add(qname, seconds)
+
+    async def decay_periodically(self, period):
+        factor = 0.5 ** (period / self.half_life)
+        while True:
+            await asyncio.sleep(period)
+            for sketch in self.sketches.values():
+                sketch.decay(factor)
+
+    def top(self, kind, count):
+        sketch = self.sketches[kind]
+        return {
+            "unit": self.units[kind],
+            "total": sketch.total,
+            "top": [{"key": key, "weight": weight, "error": error} for key, weight, error in sketch.top(count)],
+        }
@@ -0,0 +1,62 @@
+import socket
+import ipaddress
+
+# ipv4 addresses travel through the query path (answers, cache, matchers, fake ip pools) as 32-bit ints
+# strings are only made at the edges: traces, logs and the cmdline tool
+
+
+# lenient and fast, for addresses from the network or from files, raises OSError
+def ip_to_int(ip):
+    return int.from_bytes(socket.inet_aton(ip), "big")
+
+
+def int_to_ip(ip):
+    return socket.inet_ntoa(ip.to_bytes(4, "big"))
+
+
+# strict, for addresses given in rules, raises ValueError
+def parse_ip(ip):
+    return int(ipaddress.IPv4Address(ip))
+
+
+# (network, prefixlen) of "a.b.c.d" or "a.b.c.d/len", raises ValueError
+def parse_network(network):
+    net = ipaddress.IPv4Network(network, strict = False)
+    return int(net.network_address), net.prefixlen
+
+
+# answer: [(ip, ttl)]
+def format_answer(answer):
+    return ",".join(f"{int_to_ip(ip)}(ttl={ttl})" for ip, ttl in answer)
+
+
+# ips and networks of a set, for "ip in ipset" lookups with int ips
+# elements that are neither are ignored, e.g. domains of a set shared with qname matchers
+class IPv4Set:
+    def __init__(self, elements):
+        self.exact = set()
+        self.networks = dict() # prefixlen, {network >> (32 - prefixlen)}
+        for element in elements:
+            if "/" not in element:
+                if element.count(".") == 3:
+                    try:
+                        self.exact.add(ip_to_int(element))
+                    except OSError:
+                        pass
+                continue
+            try:
+                network, prefixlen = parse_network(element)
+            except ValueError:
+                continue
+            if prefixlen == 32:
+                self.exact.add(network)
+            else:
+                self.networks.setdefault(prefixlen, set()).add(network >> (32 - prefixlen))
+
+    def __contains__(self, ip):
+        if ip in self.exact:
+            return True
+        for prefixlen, networks in self.networks.items():
+            if ip >> (32 - prefixlen) in networks:
+                return True
+        return False
@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+from collections import deque
+
+# records are (timestamp, level, tracer, msg), level and tracer are None for plain log messages
+# they are formatted and written in batches by a writer thread, off the event loop
+class DNSTLogger:
+    _instance = None
+    policies = ["drop", "sample"]
+    formats = ["text", "json"]
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance == None:
+            cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def configure(cls, **kwargs):
+        if cls._instance != None:
+            cls._instance.close()
+        cls._instance = cls(**kwargs)
+        return cls._instance
+
+    # path: log file, stdout if None
+    # max_queue: records waiting to be written, records beyond that are dropped
+    # policy: "drop" only drops when the queue is full
+    #         "sample" also keeps only one record out of `sample` once the queue is half full
+    # max_bytes: rotate the log file when it grows beyond max_bytes, 0 to never rotate
+    # backups: number of rotated files to keep, as path.1 ... path.N
+    def __init__(self, path = None, fmt = "text", max_queue = 65536, policy = "drop", sample = 10,
+                 max_bytes = 0, backups = 3, flush_interval = 0.2):
+        self.path = path
+        self.fmt = fmt
+        self.max_queue = max_queue
+        self.policy = policy
+        self.sample = sample
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self._reported_drops = 0
+        self._sample_counter = 0
+        self._stats_lock = threading.Lock() # between the writer reporting drops and a reset
+
+        self._records = deque()
+        self._closed = False
+        self._file = None
+        self._size = 0
+        self._open()
+        self._writer = threading.Thread(target = self._write_loop, daemon = True)
+        self._writer.start()
+
+    def _open(self):
+        if self.path == None:
+            self._file = sys.stdout
+            return
+        self._file = open(self.path, "a")
+        self._size = self._file.tell()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def _format(self, record):
+        timestamp, lvl, tracer, msg = record
+        if self.fmt == "json":
+            entry = {"time": timestamp, "msg": msg}
+            if lvl != None:
+                entry["level"] = lvl
+                entry["tracer"] = tracer
+            return json.dumps(entry)
+        timestamp = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+        if lvl != None:
+            return f"[{timestamp}] level={lvl}\ttracer={tracer}\t{msg}"
+        return f"[{timestamp}] {msg}"
+
+    def _write_loop(self):
+        while True:
+            closed = self._closed
+            # deque append/popleft are atomic, so producers never wait on a lock
+            batch = []
+            while len(self._records) > 0:
+                batch.append(self._records.popleft())
+
+            with self._stats_lock:
+                self._report_drops(batch)
+
+            if len(batch) > 0:
+                data = "\n".join(self._format(record) for record in batch) + "\n"
+                try:
+                    self._file.write(data)
+                    self._file.flush()
+                    with self._stats_lock:
+                        self.written += len(batch)
+                    self._size += len(data)
+                    if self.max_bytes > 0 and self.path != None and self._size >= self.max_bytes:
+                        self._rotate()
+                except Exception as e:
+                    print(f"failed to write log: {e}", file = sys.stderr)
+
+            if closed:
+                break
+            # let records accumulate into bigger batches
+            time.sleep(self.flush_interval)
+
+    def _admit(self, pending):
+        if pending >= self.max_queue:
+            self.dropped += 1
+            return False
+        if self.policy == "sample" and pending >= self.max_queue // 2:
+            self._sample_counter += 1
+            if self._sample_counter % self.sample != 0:
+                self.sampled_out += 1
+                return False
+        return True
+
+    # never blocks, records are dropped according to the policy instead
+    def write(self, record):
+        if self._admit(len(self._records)):
+            self._records.append(record)
+
+    def write_many(self, records):
+        for record in records:
+            if self._admit(len(self._records)):
+                self._records.append(record)
+
+    def log(self, msg):
+        self.write((time.time(), None, None, msg))
+
+    async def aprint(self, msg):
+        self.log(msg)
+
+    def _report_drops(self, batch):
+        dropped = self.dropped + self.sampled_out
+        if dropped != self._reported_drops:
+            batch.append((time.time(), None, None,
+                          f"logger dropped {dropped - self._reported_drops} records"))
+            self._reported_drops = dropped
+
+    # drops not reported yet are still written to the log
+    def reset_stats(self):
+        with self._stats_lock:
+            pending = []
+            self._report_drops(pending)
+            self._records.extend(pending)
+            self.written = 0
+            self.dropped = 0
+            self.sampled_out = 0
+            self._reported_drops = 0
+
+    def stats(self):
+        return {
+            "queued": len(self._records),
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+        }
+
+    # write whatever is queued, then stop the writer thread
+    def close(self):
+        self._closed = True
+        self._writer.join()
+        if self.path != None:
+            self._file.close()
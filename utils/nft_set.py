@@ -0,0 +1,127 @@
+import time
+import threading
+from collections import deque
+from nftables import Nftables
+from utils.nft_wrapper import add_set_elements_cmd
+from utils.ipv4 import int_to_ip
+from utils.logger import DNSTLogger
+
+families = ["ip", "inet"]
+PRUNE_EVERY = 4096 # queued ips between two sweeps of the expired ones
+
+
+# adds answers to nftables sets with a timeout of their ttl, like dnsmasq's nftset option
+# the query path only queues the ips that are not in the set, or have less than half of their new ttl left there,
+# a worker thread writes what was queued during flush_interval with a single libnftables call,
+# i.e. one netlink transaction, so replies never wait for nftables
+class DNSTNftSets:
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance == None:
+            cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def configure(cls, **kwargs):
+        cls._instance = cls(**kwargs)
+        return cls._instance
+
+    def __init__(self, flush_interval = 0.05, max_queue = 65536):
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.present = dict() # (family, table, set), {ip: expiry}, only used from the loop
+        self.pending = deque() # ((family, table, set), ip, timeout)
+        self.failed = deque() # ((family, table, set), ip) the worker could not add, forgotten from present by the loop
+        self.worker = None
+        self._since_prune = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.queued = 0
+        self.deduped = 0
+        self.dropped = 0
+        self.added = 0
+        self.batches = 0
+        self.errors = 0
+
+    # target: (family, table, set), answer: [(ip, ttl)]
+    def add(self, target, answer):
+        now = time.monotonic()
+        while len(self.failed) > 0:
+            failed_target, ip = self.failed.popleft()
+            self.present.get(failed_target, {}).pop(ip, None)
+        present = self.present.get(target)
+        if present == None:
+            present = self.present[target] = dict()
+        for ip, ttl in answer:
+            timeout = max(ttl, 1)
+            expiry = present.get(ip)
+            # the kernel counts the timeout from a bit later, so the element lasts at least until expiry
+            # adding an element already in the set only refreshes its timeout on recent kernels
+            if expiry != None and expiry - now >= timeout / 2:
+                self.deduped += 1
+                continue
+            if len(self.pending) >= self.max_queue:
+                self.dropped += 1
+                continue
+            present[ip] = now + timeout
+            self.pending.append((target, ip, timeout))
+            self.queued += 1
+            self._since_prune += 1
+
+        if self._since_prune >= PRUNE_EVERY:
+            self._since_prune = 0
+            for target, present in self.present.items():
+                self.present[target] = {ip: expiry for ip, expiry in present.items() if expiry > now}
+        if self.worker == None:
+            self.worker = threading.Thread(target = self._write_loop, daemon = True)
+            self.worker.start()
+
+    def _write_loop(self):
+        nft = Nftables()
+        while True:
+            time.sleep(self.flush_interval)
+            batch = dict() # target, {ip: timeout}
+            # deque popleft is atomic, the loop never waits for the worker
+            while len(self.pending) > 0:
+                target, ip, timeout = self.pending.popleft()
+                elements = batch.setdefault(target, dict())
+                elements[ip] = max(timeout, elements.get(ip, 0))
+            if len(batch) > 0:
+                self._write(nft, batch)
+
+    def _cmd(self, target, elements):
+        return add_set_elements_cmd(*target, {int_to_ip(ip): timeout for ip, timeout in elements.items()})
+
+    def _write(self, nft, batch):
+        cmds = [self._cmd(target, elements) for target, elements in batch.items()]
+        self.batches += 1
+        rc, output, error = nft.json_cmd({"nftables": cmds})
+        if rc == 0:
+            self.added += sum(len(elements) for elements in batch.values())
+            return
+        # the whole transaction was rejected, find which sets are at fault
+        for target, elements in batch.items():
+            if len(batch) > 1:
+                rc, output, error = nft.json_cmd({"nftables": [self._cmd(target, elements)]})
+            if rc == 0:
+                self.added += len(elements)
+                continue
+            self.errors += 1
+            # so that the next answer with these ips queues them again, e.g. once the set is created
+            self.failed.extend((target, ip) for ip in elements)
+            DNSTLogger.get_instance().log(f"[ERROR] nftset failed to add {len(elements)} elements to {' '.join(target)}: {error.strip()}")
+
+    def stats(self):
+        return {
+            "queued": self.queued,
+            "deduped": self.deduped,
+            "dropped": self.dropped,
+            "pending": len(self.pending),
+            "added": self.added,
+            "batches": self.batches,
+            "errors": self.errors,
+            "tracked": {" ".join(target): len(present) for target, present in self.present.items()},
+        }
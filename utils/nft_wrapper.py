@@ -83,3 +83,17 @@ class NftWrapper:
             }
         }])
 
+
+# command adding ips to a set, each with its own timeout, elements: {ip: timeout in seconds}
+# the set needs the timeout flag, e.g., "nft add set ip filter routed { type ipv4_addr ; flags timeout ; }"
+def add_set_elements_cmd(family, table, name, elements):
+    return {
+        'add': {
+            'element': {
+                'family': family,
+                'table': table,
+                'name': name,
+                'elem': [{'elem': {'val': ip, 'timeout': timeout}} for ip, timeout in elements.items()]
+            }
+        }
+    }
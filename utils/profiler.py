@@ -0,0 +1,68 @@
+import sys
+import time
+import threading
+from collections import deque, Counter
+from utils.logger import DNSTLogger
+
+class DNSTProfiler:
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance == None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, max_timelines = 1000):
+        self.enabled = False
+        self.timelines = deque(maxlen = max_timelines)
+        self.sampler = None
+
+    # timeline: list of (event, start_ns, duration_ns), start_ns taken from time.perf_counter_ns()
+    # recorded events are (offset_ns, duration_ns, event) relative to start_ns, ordered by offset
+    def record(self, query, start_ns):
+        self.timelines.append({
+            "qname": query.qname,
+            "src": f"{query.src}:{query.src_port}",
+            "total_ns": time.perf_counter_ns() - start_ns,
+            "events": sorted((t - start_ns, duration, event) for event, t, duration in query.timeline),
+        })
+
+    def start_sampling(self, seconds, path, interval = 0.001):
+        if self.sampler != None and self.sampler.is_alive():
+            return False
+        self.sampler = StackSampler(threading.main_thread().ident, seconds, path, interval)
+        self.sampler.start()
+        return True
+
+
+# samples the stack of the event loop thread from another thread
+# result is written in the "folded" format used by flamegraph.pl / speedscope
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id, seconds, path, interval):
+        super().__init__(daemon = True)
+        self.thread_id = thread_id
+        self.seconds = seconds
+        self.path = path
+        self.interval = interval
+        self.stacks = Counter()
+
+    def run(self):
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame != None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            if len(stack) > 0:
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+        try:
+            with open(self.path, "w") as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            DNSTLogger.get_instance().log(f"[ERROR] failed to write profile samples to {self.path}: {e}")
@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import argparse
+import threading
+from collections import deque
+from utils.ipv4 import int_to_ip
+from utils.logger import DNSTLogger
+
+# query log stream format:
+#   header: MAGIC, version (u8)
+#   frames: payload length (u16), payload
+# payload, network byte order:
+#   timestamp ns (u64), latency us (u32), src (4 bytes), src port (u16), qtype (u16),
+#   verdict (u8), answer count (u8), qname length (u8), rule length (u8),
+#   qname, rule, answer count * (ip (4 bytes), ttl (u32))
+MAGIC = b"DNSTQLOG"
+VERSION = 1
+frame_header = struct.Struct("!H")
+payload_header = struct.Struct("!QI4sHHBBBB")
+answer_struct = struct.Struct("!II")
+verdicts = ["reply", "nxdomain", "drop", "truncate"]
+
+
+def encode(record):
+    timestamp_ns, latency_ns, src, src_port, qname, qtype, verdict, answer, rule = record
+    qname = qname.encode()[:255]
+    rule = (rule or "").encode()[:255]
+    answer = answer[:255]
+    payload = b"".join([
+        payload_header.pack(timestamp_ns, min(latency_ns // 1000, 0xffffffff), socket.inet_aton(src),
+                            src_port, qtype, verdicts.index(verdict), len(answer), len(qname), len(rule)),
+        qname,
+        rule,
+        b"".join(answer_struct.pack(ip, ttl) for ip, ttl in answer),
+    ])
+    return frame_header.pack(len(payload)) + payload
+
+
+def decode(payload):
+    (timestamp_ns, latency_us, src, src_port, qtype,
+     verdict, answer_cnt, qname_len, rule_len) = payload_header.unpack_from(payload)
+    offset = payload_header.size
+    qname = payload[offset:offset + qname_len].decode()
+    offset += qname_len
+    rule = payload[offset:offset + rule_len].decode()
+    offset += rule_len
+    answer = []
+    for _ in range(answer_cnt):
+        ip, ttl = answer_struct.unpack_from(payload, offset)
+        answer.append((int_to_ip(ip), ttl))
+        offset += answer_struct.size
+    return {
+        "time_ns": timestamp_ns,
+        "latency_us": latency_us,
+        "src": f"{socket.inet_ntoa(src)}:{src_port}",
+        "qname": qname,
+        "qtype": qtype,
+        "verdict": verdicts[verdict],
+        "rule": rule if rule_len > 0 else None,
+        "answer": answer,
+    }
+
+
+# records are only queued on the query path, encoding and writing happen in a writer thread
+# target: a file path, or "unix:PATH" to stream to a listening unix socket
+class DNSTQueryLog:
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        return cls._instance
+
+    @classmethod
+    def configure(cls, **kwargs):
+        if cls._instance != None:
+            cls._instance.close()
+        cls._instance = cls(**kwargs)
+        return cls._instance
+
+    def __init__(self, target, max_queue = 65536, flush_interval = 0.2):
+        self.target = target
+        self.max_queue = max_queue
+        self.flush_interval = flush_interval
+        self.reset_stats()
+        self._records = deque()
+        self._closed = False
+        self._out = None
+        self._good_size = None # size of the file after the last complete batch, a failed write is cut back to it
+        self._writer = threading.Thread(target = self._write_loop, daemon = True)
+        self._writer.start()
+
+    # record: (timestamp ns, latency ns, src, src port, qname, qtype, verdict, answer, rule)
+    def write(self, record):
+        if len(self._records) >= self.max_queue:
+            self.dropped += 1
+            return
+        self._records.append(record)
+
+    def _connect(self):
+        if self.target.startswith("unix:"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.target[5:])
+            except OSError:
+                sock.close()
+                return None
+            out = sock.makefile("wb")
+            sock.close() # the socket is closed along with out
+        else:
+            out = open(self.target, "ab")
+            # a failed write may have left a torn record behind
+            if self._good_size != None and out.tell() > self._good_size:
+                out.truncate(self._good_size)
+                out.seek(0, os.SEEK_END)
+            if out.tell() > 0:
+                return out
+        out.write(MAGIC + bytes([VERSION]))
+        return out
+
+    def _write_loop(self):
+        while True:
+            closed = self._closed
+            batch = []
+            while len(self._records) > 0:
+                record = self._records.popleft()
+                # a record that can't be encoded is dropped alone, the writer keeps running
+                try:
+                    batch.append(encode(record))
+                except Exception as e:
+                    self.dropped += 1
+                    DNSTLogger.get_instance().log(f"[ERROR] query log failed to encode {record}: {e}")
+
+            if len(batch) > 0:
+                if self._out == None:
+                    try:
+                        self._out = self._connect()
+                    except OSError as e:
+                        DNSTLogger.get_instance().log(f"[ERROR] query log failed to open {self.target}: {e}")
+                if self._out == None: # collector is not listening
+                    self.dropped += len(batch)
+                else:
+                    try:
+                        self._out.write(b"".join(batch))
+                        self._out.flush()
+                        self.written += len(batch)
+                        if not self.target.startswith("unix:"):
+                            self._good_size = self._out.tell()
+                    except OSError:
+                        self.dropped += len(batch)
+                        try:
+                            self._out.close()
+                        except OSError:
+                            pass
+                        self._out = None
+
+            if closed:
+                break
+            time.sleep(self.flush_interval)
+
+    def reset_stats(self):
+        self.written = 0
+        self.dropped = 0
+
+    def stats(self):
+        return {
+            "queued": len(self._records),
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+    def close(self):
+        self._closed = True
+        self._writer.join()
+        if self._out != None:
+            self._out.close()
+
+
+# reader side
+def read_stream(f):
+    header = f.read(len(MAGIC) + 1)
+    if len(header) < len(MAGIC) + 1 or header[:len(MAGIC)] != MAGIC:
+        raise ValueError("not a dnstables query log")
+    if header[-1] != VERSION:
+        raise ValueError(f"unsupported query log version {header[-1]}")
+    while True:
+        length = f.read(frame_header.size)
+        if len(length) < frame_header.size:
+            return
+        payload = f.read(frame_header.unpack(length)[0])
+        yield decode(payload)
+
+
+def print_record(record, as_json):
+    if as_json:
+        print(json.dumps(record))
+        return
+    answer = ",".join(f"{ip}(ttl={ttl})" for ip, ttl in record["answer"])
+    print(f"{record['time_ns'] / 1e9:.6f} {record['src']} {record['qname']} qtype={record['qtype']} "
+          f"{record['verdict']} rule={record['rule']} latency={record['latency_us']}us {answer}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "read a dnstables query log")
+    parser.add_argument("path", help = "query log file, or with --listen, the unix socket to listen on")
+    parser.add_argument("--listen", action = "store_true", help = "listen on the unix socket for the daemon")
+    parser.add_argument("--json", action = "store_true", help = "print JSON lines")
+    args = parser.parse_args()
+
+    if not args.listen:
+        with open(args.path, "rb") as f:
+            for record in read_stream(f):
+                print_record(record, args.json)
+        return
+
+    if os.path.exists(args.path):
+        os.remove(args.path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(args.path)
+        server.listen(1)
+        while True:
+            conn, _ = server.accept()
+            with conn, conn.makefile("rb") as f:
+                try:
+                    for record in read_stream(f):
+                        print_record(record, args.json)
+                        sys.stdout.flush()
+                except ValueError as e:
+                    print(f"error: {e}", file = sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
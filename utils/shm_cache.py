@@ -0,0 +1,162 @@
+import os
+import time
+import mmap
+import zlib
+import fcntl
+import struct
+
+# cache view stored in a memory mapped file, shared by every dnstables process attached to it
+# file: header, then fixed size slots
+# slot: seq (u32), key hash (u32), expiry (f64, of the last answer to expire), key length (u16),
+#       answer count (u8), padding, key (qname "\0" qtype), answers (ip u32, expiry f64)
+# expiries are time.monotonic() values, which are host wide on linux
+#
+# readers never lock: each slot is protected by a seqlock, seq is odd while a writer updates the slot,
+# and readers retry if seq was odd or changed while they copied the slot
+# writers serialize with flock(), writes only happen after upstream answers so they are rare
+MAGIC = b"DNSTSHMC"
+VERSION = 2
+file_header = struct.Struct("=8sIII44x") # magic, version, slot count, slot size, padded to 64 bytes
+slot_header = struct.Struct("=IIdHB5x")
+seq_struct = struct.Struct("=I")
+answer_struct = struct.Struct("=Id")
+SLOT_SIZE = 512
+MAX_KEY = 272
+MAX_ANSWERS = (SLOT_SIZE - slot_header.size - MAX_KEY) // answer_struct.size
+PROBES = 4 # slots a key can live in
+READ_RETRIES = 3
+
+
+class SharedCacheView:
+    def __init__(self, name, path, slots):
+        self.name = name
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            # the first process creates the table, the others attach to it as it is
+            if os.fstat(self.fd).st_size < file_header.size:
+                os.ftruncate(self.fd, file_header.size + slots * SLOT_SIZE)
+                os.pwrite(self.fd, file_header.pack(MAGIC, VERSION, slots, SLOT_SIZE), 0)
+            magic, version, slots, slot_size = file_header.unpack(os.pread(self.fd, file_header.size, 0))
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        if magic != MAGIC or version != VERSION or slot_size != SLOT_SIZE:
+            os.close(self.fd)
+            raise ValueError(f"{path} is not a dnstables shared cache of version {VERSION}")
+        self.slots = slots
+        self.max_entries = slots
+        self.mm = mmap.mmap(self.fd, file_header.size + slots * SLOT_SIZE)
+
+    def _offsets(self, key_hash):
+        first = key_hash % self.slots
+        return [file_header.size + ((first + i) % self.slots) * SLOT_SIZE for i in range(PROBES)]
+
+    # consistent copy of a slot, or None if writers kept changing it
+    def _read_slot(self, offset):
+        mm = self.mm
+        for _ in range(READ_RETRIES):
+            seq = seq_struct.unpack_from(mm, offset)[0]
+            if seq & 1:
+                continue
+            data = mm[offset:offset + SLOT_SIZE]
+            if seq_struct.unpack_from(mm, offset)[0] == seq:
+                return data
+        return None
+
+    def _lookup(self, qname, qtype, now):
+        key = f"{qname}\0{qtype}".encode()
+        key_hash = zlib.crc32(key)
+        for offset in self._offsets(key_hash):
+            data = self._read_slot(offset)
+            if data == None:
+                continue
+            _, slot_hash, expiry, key_len, count = slot_header.unpack_from(data)
+            if slot_hash != key_hash or expiry <= now or data[slot_header.size:slot_header.size + key_len] != key:
+                continue
+            answer = []
+            for i in range(count):
+                ip, expiry_time = answer_struct.unpack_from(data, slot_header.size + MAX_KEY + i * answer_struct.size)
+                if expiry_time > now:
+                    answer.append((ip, int(expiry_time - now)))
+            if len(answer) > 0:
+                return answer
+        return None
+
+    def get(self, qname, qtype, now):
+        answer = self._lookup(qname, qtype, now)
+        if answer != None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return answer
+
+    def contains(self, qname, qtype, now):
+        return self._lookup(qname, qtype, now) != None
+
+    # fake ip mappings belong to the process that made them, they are never shared
+    # expired slots are reused by later writes, so there is nothing for DNSTCache to clean up
+    def put(self, qname, qtype, answer, pool):
+        if pool != None:
+            return None
+        key = f"{qname}\0{qtype}".encode()
+        if len(key) > MAX_KEY:
+            return None
+        answer = answer[:MAX_ANSWERS]
+        key_hash = zlib.crc32(key)
+        mm = self.mm
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            # same key, else a free or expired slot, else the one expiring first
+            target = None
+            target_expiry = None
+            for offset in self._offsets(key_hash):
+                _, slot_hash, expiry, key_len, _ = slot_header.unpack_from(mm, offset)
+                if slot_hash == key_hash and mm[offset + slot_header.size:offset + slot_header.size + key_len] == key:
+                    target = offset
+                    target_expiry = None
+                    break
+                if target_expiry == None or expiry < target_expiry:
+                    target = offset
+                    target_expiry = expiry
+            if target_expiry != None and target_expiry > time.monotonic():
+                self.evictions += 1
+            seq = seq_struct.unpack_from(mm, target)[0]
+            seq = seq + 1 if seq % 2 == 0 else seq # odd: update in progress
+            seq_struct.pack_into(mm, target, seq)
+            slot_header.pack_into(mm, target, seq, key_hash, max(expiry_time for _, expiry_time in answer), len(key), len(answer))
+            mm[target + slot_header.size:target + slot_header.size + len(key)] = key
+            for i, (ip, expiry_time) in enumerate(answer):
+                answer_struct.pack_into(mm, target + slot_header.size + MAX_KEY + i * answer_struct.size, ip, expiry_time)
+            seq_struct.pack_into(mm, target, (seq + 1) & 0xffffffff)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return None
+
+    def expire(self, qname, qtype, now):
+        return None
+
+    def resize(self, max_entries):
+        pass # fixed when the file is created
+
+    # live slots, from a strided view of the slot expiries
+    def entries(self):
+        now = time.monotonic()
+        header_doubles = file_header.size // 8
+        with memoryview(self.mm) as view, view.cast("d") as doubles:
+            return sum(1 for expiry in doubles[header_doubles + 1::SLOT_SIZE // 8] if expiry > now)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": self.entries(),
+            "max_entries": self.slots,
+            "shared": self.path,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups > 0 else None,
+        }
@@ -0,0 +1,38 @@
+import gc
+import os
+import mmap
+import pickle
+
+# snapshot file: MAGIC, version (u8), pickled payload
+# bump VERSION whenever rules, matchers or actions change in a way older snapshots can't be loaded into
+MAGIC = b"DNSTSNAP"
+VERSION = 5
+
+
+# written to a temporary file first, so a running daemon never loads a partial snapshot
+def write_snapshot(path, payload):
+    data = pickle.dumps(payload, protocol = pickle.HIGHEST_PROTOCOL)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC + bytes([VERSION]))
+        f.write(data)
+    os.replace(tmp, path)
+    return len(data) + len(MAGIC) + 1
+
+
+# raises ValueError if path is not a snapshot of this version
+def read_snapshot(path):
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as m:
+        if m[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a dnstables snapshot")
+        if m[len(MAGIC)] != VERSION:
+            raise ValueError(f"unsupported snapshot version {m[len(MAGIC)]}, expected {VERSION}")
+        # unpickling creates millions of objects that all survive, collecting meanwhile only wastes time
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with memoryview(m) as view, view[len(MAGIC) + 1:] as data:
+                return pickle.loads(data)
+        finally:
+            if gc_enabled:
+                gc.enable()
@@ -0,0 +1,146 @@
+import bisect
+
+# latency bucket upper bounds in seconds (prometheus style)
+latency_buckets = [
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+]
+
+class Histogram:
+    def __init__(self, buckets = latency_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def observe_ns(self, ns):
+        self.observe(ns / 1e9)
+
+    # estimate with bucket upper bound
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, cnt in enumerate(self.counts):
+            seen += cnt
+            if seen >= rank and cnt > 0:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def cumulative(self):
+        seen = 0
+        for i, cnt in enumerate(self.counts):
+            seen += cnt
+            le = str(self.buckets[i]) if i < len(self.buckets) else "+Inf"
+            yield le, seen
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": dict(self.cumulative()),
+        }
+
+
+class UpstreamStats:
+    def __init__(self):
+        self.queries = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.servfail = 0 # replies, counted as failures by the circuit breaker
+        self.skipped = 0 # while the upstream was down
+        self.tcp_retries = 0 # after a truncated udp reply
+        self.rtt = Histogram()
+
+    def to_dict(self):
+        return {
+            "queries": self.queries,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "servfail": self.servfail,
+            "skipped": self.skipped,
+            "tcp_retries": self.tcp_retries,
+            "rtt": self.rtt.to_dict(),
+        }
+
+
+class DNSTStats:
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance == None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.chain_latency = dict() # hook, Histogram
+        self.action_latency = dict() # action_str, Histogram
+        self.upstreams = dict() # "ip:port", UpstreamStats
+
+    def observe_chain(self, hook, ns):
+        if hook not in self.chain_latency:
+            self.chain_latency[hook] = Histogram()
+        self.chain_latency[hook].observe_ns(ns)
+
+    def observe_action(self, action_str, ns):
+        if action_str not in self.action_latency:
+            self.action_latency[action_str] = Histogram()
+        self.action_latency[action_str].observe_ns(ns)
+
+    def upstream(self, upstream):
+        if upstream not in self.upstreams:
+            self.upstreams[upstream] = UpstreamStats()
+        return self.upstreams[upstream]
+
+
+def _label_str(labels):
+    if len(labels) == 0:
+        return ""
+    escaped = [
+        (k, str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for k, v in labels.items()
+    ]
+    return "{" + ",".join(f"{k}=\"{v}\"" for k, v in escaped) + "}"
+
+
+# build prometheus text exposition lines
+class PrometheusWriter:
+    def __init__(self, prefix = "dnst"):
+        self.prefix = prefix
+        self.lines = []
+        self.declared = set()
+
+    def _declare(self, name, metric_type):
+        if name not in self.declared:
+            self.declared.add(name)
+            self.lines.append(f"# TYPE {name} {metric_type}")
+
+    def counter(self, name, value, **labels):
+        name = f"{self.prefix}_{name}"
+        self._declare(name, "counter")
+        self.lines.append(f"{name}{_label_str(labels)} {value}")
+
+    def gauge(self, name, value, **labels):
+        name = f"{self.prefix}_{name}"
+        self._declare(name, "gauge")
+        self.lines.append(f"{name}{_label_str(labels)} {value}")
+
+    def histogram(self, name, hist, **labels):
+        name = f"{self.prefix}_{name}"
+        self._declare(name, "histogram")
+        for le, cnt in hist.cumulative():
+            self.lines.append(f"{name}_bucket{_label_str(dict(labels, le = le))} {cnt}")
+        self.lines.append(f"{name}_sum{_label_str(labels)} {hist.sum}")
+        self.lines.append(f"{name}_count{_label_str(labels)} {hist.count}")
+
+    def __str__(self):
+        return "\n".join(self.lines) + "\n"
@@ -0,0 +1,122 @@
+import time
+import socket
+import asyncio
+from collections import deque
+from dnslib import DNSRecord, RCODE
+from utils import edns
+
+class UpstreamHealth:
+    window = 20 # recent queries to compute the error rate from
+    max_consecutive_failures = 5
+    max_error_rate = 0.5
+    min_timeout = 0.2
+    max_timeout = 5
+    rtt_factor = 3 # timeout is rtt_factor * p99 rtt, within [min_timeout, max_timeout]
+    update_every = 20 # successes between two p99 computations, sooner when an rtt is above it
+    probe_interval = 1
+
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.is_open = False # circuit breaker state, upstream is skipped while open
+        self.opened = 0
+        self.consecutive_failures = 0
+        self.outcomes = deque(maxlen = self.window) # True on success
+        self.rtts = deque(maxlen = 200)
+        self._timeout = self.max_timeout
+        self._p99 = None
+        self._since_update = 0
+        self._prober = None
+
+    def available(self):
+        return not self.is_open
+
+    # adapts to the observed rtt once there are enough samples
+    def timeout(self):
+        return self._timeout
+
+    # sorting the rtts on every success is too costly on the query path, the timeout only lags when rtts drop
+    def _update_timeout(self, rtt):
+        if len(self.rtts) < self.window:
+            self._timeout = self.max_timeout
+            return
+        self._since_update += 1
+        if self._p99 != None and self._since_update < self.update_every and rtt <= self._p99:
+            return
+        self._since_update = 0
+        rtts = sorted(self.rtts)
+        self._p99 = rtts[min(len(rtts) - 1, int(len(rtts) * 0.99))]
+        self._timeout = min(self.max_timeout, max(self.min_timeout, self._p99 * self.rtt_factor))
+
+    def success(self, rtt):
+        self.consecutive_failures = 0
+        self.outcomes.append(True)
+        self.rtts.append(rtt)
+        self._update_timeout(rtt)
+
+    def failure(self):
+        self.consecutive_failures += 1
+        self.outcomes.append(False)
+        if self.is_open:
+            return
+        error_rate = self.outcomes.count(False) / len(self.outcomes)
+        if self.consecutive_failures >= self.max_consecutive_failures or \
+                (len(self.outcomes) == self.window and error_rate > self.max_error_rate):
+            self._open()
+
+    def _open(self):
+        self.is_open = True
+        self.opened += 1
+        if self._prober == None or self._prober.done():
+            self._prober = asyncio.ensure_future(self._probe())
+
+    def _close(self):
+        self.is_open = False
+        self.consecutive_failures = 0
+        self.outcomes.clear()
+
+    # any reply to a root NS query other than SERVFAIL means the upstream is back
+    async def _probe(self):
+        loop = asyncio.get_event_loop()
+        probe = DNSRecord.question(".", "NS").pack()
+        while self.is_open:
+            await asyncio.sleep(self.probe_interval)
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.setblocking(False)
+                try:
+                    start = time.perf_counter()
+                    await loop.sock_sendto(sock, probe, (self.ip, self.port))
+                    response = await asyncio.wait_for(loop.sock_recv(sock, edns.MAX_UDP_SIZE), timeout = self.max_timeout)
+                    rcode = DNSRecord.parse(response).header.rcode
+                    if rcode != RCODE.SERVFAIL:
+                        self.rtts.append(time.perf_counter() - start)
+                        self._close()
+                except Exception:
+                    pass
+
+    def stats(self):
+        return {
+            "state": "open" if self.is_open else "closed",
+            "opened": self.opened,
+            "consecutive_failures": self.consecutive_failures,
+            "timeout": self._timeout,
+        }
+
+
+class DNSTUpstreams:
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance == None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.upstreams = dict() # "ip:port", UpstreamHealth
+
+    def get(self, ip, port):
+        key = f"{ip}:{port}"
+        if key not in self.upstreams:
+            self.upstreams[key] = UpstreamHealth(ip, port)
+        return self.upstreams[key]
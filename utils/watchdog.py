@@ -0,0 +1,95 @@
+import sys
+import time
+import asyncio
+import threading
+import traceback
+from collections import deque
+from utils.stats import Histogram
+from utils.logger import DNSTLogger
+
+# loop lag bucket upper bounds in seconds
+lag_buckets = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+MAX_FRAMES = 32
+
+
+# measures how late the event loop runs its timers, and catches the callbacks that block it
+# a coroutine on the loop ticks every `interval` and records by how much each tick was late
+# a thread watches the ticks: when the loop has not ticked for `interval` + `threshold`, it is stuck in
+# one callback, whose stack is captured while that callback is still running
+class DNSTWatchdog:
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance == None:
+            cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def configure(cls, **kwargs):
+        cls._instance = cls(**kwargs)
+        return cls._instance
+
+    # threshold: 0 to disable
+    def __init__(self, threshold = 0.1, interval = 0.05, max_stalls = 16):
+        self.threshold = threshold
+        self.interval = interval
+        self.enabled = threshold > 0
+        self.recent = deque(maxlen = max_stalls) # {"time", "duration", "stack"}, latest last
+        self.reset_stats()
+        self.tick = time.monotonic()
+        self.loop_thread = None
+        self.stall = None # being captured, its duration is known at the next tick
+        self.lock = threading.Lock() # between a tick and a capture
+
+    def reset_stats(self):
+        self.lag = Histogram(lag_buckets)
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.recent.clear()
+
+    # from the loop thread, the watching starts right away, even before the loop gets to run the ticks
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        self.tick = time.monotonic()
+        threading.Thread(target = self._watch, daemon = True).start()
+        asyncio.ensure_future(self._tick_periodically())
+
+    async def _tick_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - self.tick - self.interval)
+            self.lag.observe(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+            with self.lock:
+                self.tick = now
+                if self.stall != None:
+                    self.stall["duration"] = lag
+                    self.stall = None
+
+    def _watch(self):
+        while True:
+            time.sleep(self.threshold / 2)
+            with self.lock:
+                stuck = time.monotonic() - self.tick
+                if stuck < self.interval + self.threshold or self.stall != None:
+                    continue
+                frame = sys._current_frames().get(self.loop_thread)
+                stack = [f"{fs.name} ({fs.filename}:{fs.lineno})"
+                         for fs in traceback.extract_stack(frame)[-MAX_FRAMES:]] if frame != None else []
+                self.stall = {"time": time.time(), "duration": None, "stack": stack}
+                self.recent.append(self.stall)
+                self.stalls += 1
+            DNSTLogger.get_instance().log(f"[WARN] event loop blocked for more than {(stuck - self.interval) * 1000:.0f}ms in: "
+                                          + " <- ".join(reversed(stack)))
+
+    def stats(self):
+        return {
+            "lag": self.lag.to_dict(),
+            "max_lag": self.max_lag,
+            "stall_threshold": self.threshold,
+            "stalls": self.stalls,
+            "recent_stalls": list(self.recent),
+        }
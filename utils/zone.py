@@ -0,0 +1,270 @@
+import time
+import asyncio
+from utils.element_file import file_signature
+from utils.logger import DNSTLogger
+from utils.ipv4 import parse_ip
+
+classes = ["IN", "CH", "HS", "CS"]
+ttl_units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_ttl(token):
+    if token.isdigit():
+        return int(token)
+    # BIND style durations, e.g. "1h30m"
+    ttl = 0
+    num = ""
+    for c in token.lower():
+        if c.isdigit():
+            num += c
+        elif c in ttl_units and num:
+            ttl += int(num) * ttl_units[c]
+            num = ""
+        else:
+            return None
+    return ttl if num == "" else None
+
+
+def _strip_comment(line):
+    if '"' not in line:
+        return line.split(';', 1)[0]
+    quoted = False
+    for i, c in enumerate(line):
+        if c == '"':
+            quoted = not quoted
+        elif c == ';' and not quoted:
+            return line[:i]
+    return line
+
+
+# yield (lineno, starts_with_blank, tokens) for each logical entry, joining "( ... )" continuations
+def _iter_entries(f):
+    tokens = []
+    blank_owner = False
+    depth = 0
+    start = 0
+    for lineno, line in enumerate(f, 1):
+        line = _strip_comment(line.rstrip("\n"))
+        if depth == 0:
+            if not line.strip():
+                continue
+            blank_owner = line[0] in " \t"
+            start = lineno
+        if "(" in line or ")" in line:
+            line = line.replace("(", " ( ").replace(")", " ) ")
+        for token in line.split():
+            if token == "(":
+                depth += 1
+            elif token == ")":
+                depth -= 1
+            else:
+                tokens.append(token)
+        if depth == 0 and len(tokens) > 0:
+            yield start, blank_owner, tokens
+            tokens = []
+    if depth != 0:
+        raise ValueError(f"line {start}: unbalanced parentheses")
+
+
+def _absolute(name, origin):
+    if name == "@":
+        return origin
+    if name.endswith("."):
+        return name[:-1].lower()
+    name = name.lower()
+    return f"{name}.{origin}" if origin else name
+
+
+# parse a RFC 1035 master file
+# returns (apexes, records): records maps a lowercase name without the trailing dot
+# to a tuple of (rtype, ttl, rdata) entries, wildcard owners are kept as "*.domain"
+# names that only exist as ancestors of other owners (empty non-terminals) map to an empty tuple
+# rdata of A records is the address as int, the way answers are passed around
+def parse_zone(path, origin = ""):
+    records = dict()
+    apexes = set()
+    default_ttl = None
+    last_ttl = None
+    owner = None
+    interned = dict() # share rtype strings and ttl ints between records, they repeat a lot
+    with open(path, "r", errors = "replace") as f:
+        for lineno, blank_owner, tokens in _iter_entries(f):
+            if tokens[0].upper() == "$ORIGIN":
+                origin = _absolute(tokens[1], "")
+                apexes.add(origin)
+                continue
+            if tokens[0].upper() == "$TTL":
+                default_ttl = parse_ttl(tokens[1])
+                continue
+            if tokens[0].startswith("$"):
+                raise ValueError(f"line {lineno}: unsupported directive {tokens[0]}")
+
+            if not blank_owner:
+                owner = _absolute(tokens.pop(0), origin)
+            if owner == None:
+                raise ValueError(f"line {lineno}: record without owner")
+
+            # optional ttl and class, in any order
+            ttl = None
+            while len(tokens) > 0:
+                if tokens[0].upper() in classes:
+                    tokens.pop(0)
+                elif ttl == None and parse_ttl(tokens[0]) != None:
+                    ttl = parse_ttl(tokens.pop(0))
+                else:
+                    break
+            if len(tokens) < 2:
+                raise ValueError(f"line {lineno}: missing record type or data")
+            rtype = tokens.pop(0).upper()
+
+            if ttl == None:
+                ttl = default_ttl if default_ttl != None else last_ttl
+            if rtype == "SOA":
+                apexes.add(owner)
+                if ttl == None and len(tokens) >= 7:
+                    ttl = parse_ttl(tokens[6]) # minimum field
+            if ttl == None:
+                raise ValueError(f"line {lineno}: no ttl and no $TTL")
+            last_ttl = ttl
+
+            if rtype in ["CNAME", "NS", "PTR", "DNAME"]:
+                rdata = _absolute(tokens[0], origin)
+            elif rtype == "A":
+                try:
+                    rdata = parse_ip(tokens[0])
+                except ValueError as e:
+                    raise ValueError(f"line {lineno}: {e}")
+            else:
+                rdata = " ".join(tokens)
+            rtype = interned.setdefault(rtype, rtype)
+            ttl = interned.setdefault(ttl, ttl)
+            records[owner] = records.get(owner, ()) + ((rtype, ttl, rdata),)
+    if len(apexes) == 0 and origin:
+        apexes.add(origin)
+    for owner in list(records):
+        name = owner
+        while True:
+            dot = name.find(".")
+            if dot < 0:
+                break
+            name = name[dot + 1:]
+            if name in records or name in apexes:
+                break
+            records[name] = ()
+    return apexes, records
+
+
+class Zone:
+    max_cname_chain = 8
+    check_interval = 1 # seconds between file change checks
+
+    def __init__(self, path):
+        self.path = path
+        self.apexes = set()
+        self.records = dict()
+        self.loads = 0
+        self.load_error = None
+        self._signature = None
+        self._checked = 0
+        self._reloading = False
+        self.apexes, self.records = parse_zone(path)
+        self._signature = file_signature(path)
+        self.loads += 1
+
+    def in_zone(self, name):
+        while True:
+            if name in self.apexes:
+                return True
+            dot = name.find(".")
+            if dot < 0:
+                return False
+            name = name[dot + 1:]
+
+    # exact owner first, then the wildcard of the closest existing ancestor (RFC 4592)
+    # returns None when the name does not exist
+    def lookup(self, name):
+        rrs = self.records.get(name)
+        if rrs != None:
+            return rrs
+        suffix = name
+        while True:
+            dot = suffix.find(".")
+            if dot < 0:
+                return None
+            suffix = suffix[dot + 1:]
+            if suffix in self.records or suffix in self.apexes:
+                return self.records.get("*." + suffix)
+
+    # follow CNAMEs inside the zone, returns ([(ip, ttl)], exists), exists is False for NXDOMAIN
+    # or None when the chain leaves the zone, so the query can be resolved elsewhere
+    def resolve(self, qname):
+        name = qname
+        max_ttl = None
+        for _ in range(self.max_cname_chain):
+            rrs = self.lookup(name)
+            if rrs == None:
+                return [], False
+            answer = [(rdata, ttl if max_ttl == None else min(ttl, max_ttl)) for rtype, ttl, rdata in rrs if rtype == "A"]
+            if len(answer) > 0:
+                return answer, True
+            cname = next(((ttl, rdata) for rtype, ttl, rdata in rrs if rtype == "CNAME"), None)
+            if cname == None:
+                return [], True
+            ttl, name = cname
+            max_ttl = ttl if max_ttl == None else min(ttl, max_ttl)
+            if not self.in_zone(name):
+                return None
+        return [], True
+
+    # called on the query path, the file is parsed and compared to the live index in a worker thread,
+    # then only the names that changed are written to the live index
+    def check_reload(self):
+        now = time.monotonic()
+        if self._reloading or now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        signature = file_signature(self.path)
+        if signature == None or signature == self._signature:
+            return
+        self._signature = signature
+        self._reloading = True
+        asyncio.ensure_future(self._reload())
+
+    async def _reload(self):
+        loop = asyncio.get_event_loop()
+        try:
+            apexes, records = await loop.run_in_executor(None, parse_zone, self.path)
+            changed, removed = await loop.run_in_executor(None, self._diff, records)
+        except (OSError, ValueError) as e:
+            self.load_error = str(e)
+            DNSTLogger.get_instance().log(f"failed to reload zone {self.path}: {e}")
+            return
+        finally:
+            self._reloading = False
+        # without an await, so queries never see half of a change
+        if len(changed) + len(removed) > len(self.records) // 2:
+            self.records = records # cheaper to swap the whole index
+        else:
+            for name in removed:
+                del self.records[name]
+            self.records.update(changed)
+        self.apexes = apexes
+        self.loads += 1
+        self.load_error = None
+        DNSTLogger.get_instance().log(f"reloaded zone {self.path}: {len(self.records)} names, "
+                                      f"{len(changed)} changed, {len(removed)} removed")
+
+    # the live index is only changed on the loop, after the diff
+    def _diff(self, records):
+        old = self.records
+        changed = {name: rrs for name, rrs in records.items() if old.get(name) != rrs}
+        removed = [name for name in old if name not in records]
+        return changed, removed
+
+    def stats(self):
+        return {
+            "names": len(self.records),
+            "apexes": sorted(self.apexes),
+            "loads": self.loads,
+            "load_error": self.load_error,
+        }